@@ -0,0 +1,217 @@
+import os, re, sys, json, time, random, tempfile, tracemalloc, resource, subprocess
+from argparse import ArgumentParser
+from importlib import resources as impresources
+from bpmusictransposer.musicgenerator import MusicGenerator
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.renderer import Renderer
+from . import parserdefs
+
+placeholder_re = re.compile('{{(\\w+)(?::\\d+)?}}')
+# Characters left in an expanded pattern that make it more than one literal token
+regex_chars = set("\\[](){}?*+|^$.")
+# Definitions for bars, lines, key and time, written by synthetic_tune itself rather than drawn at random
+structure_targets = ["clefc", "repeatstart", "repeatend", "barend", "lineend", "partstart", "partend", "endingstart",
+        "endingend", "sharp", "natural", "flat", "fermata", "_ignore", "common_time_notation", "half_time_notation"]
+
+def load_grammar(name="BWW.v1.0.json"):
+    return json.loads((impresources.files(parserdefs) / name).read_text())
+
+def _spellings(value):
+    '''Every way of writing one pitch of an internal definition, a dict of pitch -> spelling or spellings'''
+    return {k: v if isinstance(v, list) else [v] for (k, v) in value.items()}
+
+def _expand(pattern, internal_defs, rng):
+    def spell(match):
+        value = internal_defs.get(match.group(1))
+        if not isinstance(value, dict):
+            return match.group(0)
+        return rng.choice(rng.choice(list(_spellings(value).values())))
+    return placeholder_re.sub(spell, pattern)
+
+def embellishment_vocabulary(grammar, parser, rng, samples=20):
+    '''Literal tokens for the grammar's embellishments, each checked to parse back as its own definition'''
+    internal_defs = grammar["_internal_defs"]
+    vocabulary = []
+    for definition in grammar["_parser_defs"]:
+        target = definition.get("type", definition["target"])
+        if "apply" in definition or definition["target"] in structure_targets or target in ["note", "rest", "time_notation"]:
+            continue
+        patterns = definition["pattern"] if isinstance(definition["pattern"], list) else [definition["pattern"]]
+        found = set()
+        for x in range(samples):
+            token = _expand(rng.choice(patterns), internal_defs, rng)
+            if regex_chars & set(token) or token in found:
+                continue
+            parsed = parser.parse(token)
+            if len(parsed) == 1 and parsed[0].get_type() == target:
+                found.add(token)
+        vocabulary.extend(sorted(found))
+    return vocabulary
+
+def synthetic_tune(grammar, vocabulary, rng, bars=16, density=0.3, title="Synthetic"):
+    '''BWW text for a 4/4 tune of bars bars, about density of its notes preceded by an embellishment'''
+    pitches = _spellings(grammar["_internal_defs"]["note"])
+    dots = _spellings(grammar["_internal_defs"]["snote"])
+    def note(length, dotted=False):
+        pitch = rng.choice(list(pitches))
+        written = ["%s_%d" % (rng.choice(pitches[pitch]), length)]
+        if vocabulary and rng.random() < density:
+            written.insert(0, rng.choice(vocabulary))
+        if dotted:
+            written.append("'%s" % rng.choice(dots[pitch]))
+        return " ".join(written)
+    def beat():
+        choice = rng.random()
+        if choice < 0.4:
+            return note(4)
+        if choice < 0.7:
+            return "%s %s" % (note(8), note(8))
+        return "%s %s" % (note(8, True), note(16))
+    lines = [
+        '"%s",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)' % title,
+        '"March",(Y,C,0,0,Times New Roman,14,400,0,0,18,0,0,0)',
+        '"Benchmark",(M,R,0,0,Times New Roman,14,400,0,0,18,0,0,0)',
+        'TuneTempo,90',
+        ''
+    ]
+    for start in range(0, bars, 4):
+        line_bars = [" ".join(beat() for x in range(4)) for x in range(min(4, bars - start))]
+        line_start = "& sharpf sharpc 4_4 I!''" if start == 0 else "& sharpf sharpc"
+        line_end = "''!I" if start + 4 >= bars else "!t"
+        lines.append("%s %s %s" % (line_start, " ! ".join(line_bars), line_end))
+    return "\n".join(lines) + "\n"
+
+def synthetic_corpus(tunes=20, bars=16, density=0.3, seed=0):
+    parser = MusicParser.parsers["BagpipeMusicWriter"]
+    grammar = load_grammar()
+    rng = random.Random(seed)
+    vocabulary = embellishment_vocabulary(grammar, parser, rng)
+    return [synthetic_tune(grammar, vocabulary, rng, bars, density, "Synthetic %d" % i) for i in range(tunes)]
+
+def best_time(function, repeat, setup=None):
+    '''Fastest of repeat runs of function, with its result, calling setup untimed before each'''
+    best = None
+    for x in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+def cold_import(repeat):
+    '''Seconds to import the parser in a fresh interpreter, and to then load its definitions'''
+    script = ("import time; start = time.perf_counter(); "
+            "from bpmusictransposer.musicparser import MusicParser; imported = time.perf_counter(); "
+            "MusicParser.parsers['BagpipeMusicWriter']; loaded = time.perf_counter(); "
+            "print(imported - start, loaded - imported)")
+    runs = []
+    for x in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        runs.append([float(x) for x in output.split()])
+    return { "import_seconds": min(x[0] for x in runs), "load_parsers_seconds": min(x[1] for x in runs) }
+
+def run_benchmark(corpus, repeat=3, lilypond=None, render_batch=8):
+    parser = MusicParser.parsers["BagpipeMusicWriter"]
+    generator = MusicGenerator()
+    results = {}
+
+    # Cold, every token string goes through the matcher: what matcher changes show up in
+    (seconds, parsed) = best_time(lambda: [parser.parse(text) for text in corpus], repeat, parser.token_cache.clear)
+    tokens = sum(len(x) for x in parsed)
+    results["parse"] = { "seconds": seconds, "tokens": tokens, "tokens_per_second": tokens / seconds }
+    # Warm, repeated token strings are copied from the parsed token cache
+    (seconds, parsed) = best_time(lambda: [parser.parse(text) for text in corpus], repeat)
+    results["parse_cached"] = { "seconds": seconds, "tokens": tokens, "tokens_per_second": tokens / seconds }
+
+    tunes = [parser.get_tune(text) for text in corpus]
+    (seconds, generated) = best_time(lambda: [generator.from_tune(tune) for tune in tunes], repeat)
+    notes = sum(1 for tune in tunes for token in tune.notes if token.get_type() == "note")
+    results["generate"] = { "seconds": seconds, "notes": notes, "notes_per_second": notes / seconds }
+
+    tracemalloc.start()
+    for text in corpus:
+        generator.from_tune(parser.get_tune(text))
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in KiB on Linux
+    results["memory"] = { "peak_traced_bytes": peak, "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 }
+
+    results["import"] = cold_import(repeat)
+
+    if lilypond:
+        with tempfile.TemporaryDirectory() as workdir:
+            filenames = []
+            for (i, text) in enumerate(generated):
+                filenames.append(os.path.join(workdir, "tune%d" % i))
+                with open("%s.ly" % filenames[-1], 'w') as file:
+                    file.write(text)
+            renderer = Renderer(lilypond, batch_size=render_batch)
+            start = time.perf_counter()
+            futures = [renderer.render(filename) for filename in filenames]
+            renderer.start()
+            renderer.stop()
+            seconds = time.perf_counter() - start
+            rendered = sum(1 for future in futures if not future.exception())
+        results["render"] = { "seconds": seconds, "files": rendered, "files_per_second": rendered / seconds }
+    return results
+
+def parseargs():
+    parser = ArgumentParser(
+                    prog='Music Transposer benchmark',
+                    description="Time parsing, generation and rendering of a synthetic BWW corpus"
+                )
+    parser.add_argument('--tunes',
+                    type=int,
+                    default=20)
+    parser.add_argument('--bars',
+                    type=int,
+                    default=16,
+                    help="Bars of 4/4 in each tune")
+    parser.add_argument('--density',
+                    type=float,
+                    default=0.3,
+                    help="Share of notes with an embellishment before them")
+    parser.add_argument('--seed',
+                    type=int,
+                    default=0)
+    parser.add_argument('--repeat',
+                    type=int,
+                    default=3,
+                    help="Report the fastest of this many runs")
+    parser.add_argument('--lilypond',
+                    metavar='EXECUTABLE',
+                    help="Also time rendering with this lilypond")
+    parser.add_argument('--render-batch',
+                    type=int,
+                    default=8)
+    parser.add_argument('--write-corpus',
+                    metavar='DIR',
+                    help="Save the corpus as .bww files in DIR")
+    parser.add_argument('-o', '--output',
+                    help="Write the JSON results here instead of to stdout")
+    return parser.parse_args()
+
+def main():
+    arguments = parseargs()
+    corpus = synthetic_corpus(arguments.tunes, arguments.bars, arguments.density, arguments.seed)
+    if arguments.write_corpus:
+        os.makedirs(arguments.write_corpus, exist_ok=True)
+        for (i, text) in enumerate(corpus):
+            with open(os.path.join(arguments.write_corpus, "synthetic%d.bww" % i), 'w', encoding="cp1252") as file:
+                file.write(text)
+    report = {
+        "parameters": { k: getattr(arguments, k) for k in ["tunes", "bars", "density", "seed", "repeat"] },
+        "python": sys.version.split()[0],
+        "results": run_benchmark(corpus, arguments.repeat, arguments.lilypond, arguments.render_batch)
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+import os, json, sys, sqlite3
+
+class JournalJobStore:
+    """Job states as an append-only file of JSON lines, the last line for a job wins
+
+    A job list written by older versions (one JSON object of every job) is read as the
+    first entry. Callers serialize access, WorkerPool does so under its lock."""
+    # Rewrite the journal once it holds this many times more lines than there are jobs
+    compact_ratio = 4
+    compact_min = 1000
+
+    def load(self):
+        jobs = {}
+        legacy = False
+        self.entries = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as journal:
+                for line in journal:
+                    self.entries += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # An interrupted write only loses its own line
+                        print("Skip unreadable job entry: %s" % line.strip(), file=sys.stderr)
+                        continue
+                    if "uuid" in entry:
+                        jobs[entry["uuid"]] = entry
+                    else:
+                        jobs.update(entry)
+                        legacy = True
+        self.jobs = jobs
+        if legacy or self.entries != len(jobs):
+            self.compact()
+        return dict(jobs)
+
+    def update(self, uuid, state):
+        self.jobs[uuid] = state
+        self._journal().write("%s\n" % json.dumps(state))
+        self._journal().flush()
+        self.entries += 1
+        if self.entries > max(self.compact_min, self.compact_ratio * len(self.jobs)):
+            self.compact()
+
+    def compact(self):
+        """Replace the journal with one line per job"""
+        self.close()
+        temp_path = "%s.tmp" % self.path
+        with open(temp_path, 'w') as journal:
+            for state in self.jobs.values():
+                journal.write("%s\n" % json.dumps(state))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self.path)
+        self.entries = len(self.jobs)
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def _journal(self):
+        if not self.journal:
+            self.journal = open(self.path, 'a')
+        return self.journal
+
+    def __init__(self, path):
+        self.path = path
+        self.journal = None
+        self.jobs = {}
+        self.entries = 0
+
+class SqliteJobStore:
+    """Job states in an SQLite table, one row per job"""
+
+    def load(self):
+        rows = self.db.execute("SELECT state FROM jobs").fetchall()
+        jobs = [json.loads(row[0]) for row in rows]
+        return {job["uuid"]: job for job in jobs}
+
+    def update(self, uuid, state):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs (uuid, state) VALUES (?, ?)", (uuid, json.dumps(state)))
+
+    def compact(self):
+        self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.close()
+
+    def __init__(self, path):
+        self.path = path
+        # WorkerPool threads share the connection, its lock serializes them
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (uuid TEXT PRIMARY KEY, state TEXT NOT NULL)")
+
+job_stores = {
+    "journal": JournalJobStore,
+    "sqlite": SqliteJobStore
+}
+
+def open_job_store(path, kind="journal"):
+    return job_stores[kind](path)
@@ -0,0 +1,228 @@
+import re, sys, heapq
+from argparse import ArgumentParser
+# The regex parser is private: re._parser from Python 3.11, the deprecated sre_parse module on
+# 3.10 (the oldest supported, see requires-python). Checked on 3.11 and 3.13. Should neither be
+# there, patterns can't be compared and order_by_hits keeps them in the order given.
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    try:
+        import sre_parse, sre_constants
+    except ImportError:
+        sre_parse = sre_constants = None
+
+# Characters that stand in for every other one when comparing patterns: Latin-1, as read from
+# cp1252 files, and a few beyond it that \d, \w or \s still match
+base_alphabet = frozenset([chr(x) for x in range(256)] + ["Ā", "٣", " ", "中"])
+# Repeats with more optional copies than this are treated as unbounded
+max_unrolled = 32
+
+class Nfa:
+    """Character NFA for the language of a parsed regex, an over-approximation where a construct can't be followed
+
+    Lookarounds and anchors are ignored and backreferences match anything, which can only
+    add strings to the language: patterns are never reported disjoint when they are not."""
+
+    def state(self):
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def _chars(self, op, av):
+        if op == sre_constants.LITERAL:
+            return frozenset([chr(av)])
+        if op == sre_constants.NOT_LITERAL:
+            return self.alphabet - {chr(av)}
+        if op == sre_constants.ANY:
+            return self.alphabet - {"\n"}
+        # IN
+        negate = False
+        chars = set()
+        for (item_op, item_av) in av:
+            if item_op == sre_constants.NEGATE:
+                negate = True
+            elif item_op == sre_constants.LITERAL:
+                chars.add(chr(item_av))
+            elif item_op == sre_constants.RANGE:
+                chars.update(c for c in self.alphabet if item_av[0] <= ord(c) <= item_av[1])
+            elif item_op == sre_constants.CATEGORY:
+                chars.update(c for c in self.alphabet if self._in_category(item_av, c))
+            else:
+                return self.alphabet
+        return frozenset(self.alphabet - chars if negate else chars)
+
+    def _in_category(self, category, c):
+        name = str(category).upper()
+        tests = [("DIGIT", "\\d"), ("WORD", "\\w"), ("SPACE", "\\s"), ("LINEBREAK", "\\n")]
+        for (suffix, pattern) in tests:
+            if name.endswith("NOT_%s" % suffix):
+                return not re.fullmatch(pattern, c)
+            if name.endswith(suffix):
+                return bool(re.fullmatch(pattern, c))
+        return True
+
+    def _anything(self, start):
+        self.edges[start].append((self.alphabet, start))
+        return start
+
+    def _build(self, items, start):
+        current = start
+        for (op, av) in items:
+            if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+                following = self.state()
+                self.edges[current].append((self._chars(op, av), following))
+                current = following
+            elif op == sre_constants.BRANCH:
+                end = self.state()
+                for branch in av[1]:
+                    self.edges[self._build(branch, current)].append((None, end))
+                current = end
+            elif op == sre_constants.SUBPATTERN:
+                current = self._build(av[-1], current)
+            elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+                current = self._build(av, current)
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, "POSSESSIVE_REPEAT", None)):
+                (low, high, item) = av
+                for x in range(low):
+                    current = self._build(item, current)
+                if high == sre_constants.MAXREPEAT or high - low > max_unrolled:
+                    loop = self.state()
+                    self.edges[current].append((None, loop))
+                    self.edges[self._build(item, loop)].append((None, loop))
+                    current = loop
+                else:
+                    end = self.state()
+                    for x in range(high - low):
+                        self.edges[current].append((None, end))
+                        current = self._build(item, current)
+                    self.edges[current].append((None, end))
+                    current = end
+            elif op == sre_constants.GROUPREF_EXISTS:
+                end = self.state()
+                (group, yes, no) = av
+                self.edges[self._build(yes, current)].append((None, end))
+                self.edges[self._build(no or [], current)].append((None, end))
+                current = end
+            elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                continue
+            else:
+                # GROUPREF and anything newer: allow any string here
+                current = self._anything(current)
+        return current
+
+    def closure(self, states):
+        found = set(states)
+        pending = list(states)
+        while pending:
+            for (chars, following) in self.edges[pending.pop()]:
+                if chars is None and following not in found:
+                    found.add(following)
+                    pending.append(following)
+        return found
+
+    def first_chars(self):
+        return frozenset().union(*(chars for state in self.closure([self.start]) for (chars, following) in self.edges[state] if chars is not None))
+
+    def nullable(self):
+        return self.end in self.closure([self.start])
+
+    def __init__(self, pattern, alphabet=base_alphabet):
+        self.alphabet = alphabet
+        self.edges = []
+        self.start = self.state()
+        self.end = self._build(sre_parse.parse(pattern), self.start)
+
+def alphabet_for(patterns):
+    literals = set(re.sub(r"\\.", "", "".join(patterns)))
+    return base_alphabet | literals
+
+def overlap(a, b):
+    """Whether some string could fully match both Nfas"""
+    if not (a.nullable() and b.nullable()) and not (a.first_chars() & b.first_chars()):
+        return False
+    seen = set()
+    pending = [(a.start, b.start)]
+    while pending:
+        pair = pending.pop()
+        if pair in seen:
+            continue
+        seen.add(pair)
+        (p, q) = pair
+        if p == a.end and q == b.end:
+            return True
+        for (chars, following) in a.edges[p]:
+            if chars is None:
+                pending.append((following, q))
+        for (chars, following) in b.edges[q]:
+            if chars is None:
+                pending.append((p, following))
+        for (a_chars, a_following) in a.edges[p]:
+            if a_chars is None:
+                continue
+            for (b_chars, b_following) in b.edges[q]:
+                if b_chars is not None and a_chars & b_chars:
+                    pending.append((a_following, b_following))
+    return False
+
+def precedence(patterns):
+    """Pairs (i, j), i < j, of patterns that can match the same token, so i has to stay first"""
+    if sre_parse is None:
+        # Without the regex parser any two might overlap
+        return [(i, j) for i in range(len(patterns)) for j in range(i + 1, len(patterns))]
+    alphabet = alphabet_for(patterns)
+    nfas = [Nfa(pattern, alphabet) for pattern in patterns]
+    return [(i, j) for i in range(len(nfas)) for j in range(i + 1, len(nfas)) if overlap(nfas[i], nfas[j])]
+
+def order_by_hits(patterns, hits):
+    """Positions of patterns, most hit first wherever that can't change which pattern wins a token"""
+    before = [0 for x in patterns]
+    after = [[] for x in patterns]
+    for (i, j) in precedence(patterns):
+        before[j] += 1
+        after[i].append(j)
+    ready = [(-hits[i], i) for i in range(len(patterns)) if not before[i]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        (_, i) = heapq.heappop(ready)
+        order.append(i)
+        for j in after[i]:
+            before[j] -= 1
+            if not before[j]:
+                heapq.heappush(ready, (-hits[j], j))
+    return order
+
+def parseargs():
+    parser = ArgumentParser(
+                    prog='Music Transposer matcher order',
+                    description="Count which token patterns match across a corpus, and learn a faster order to try them in"
+                )
+    parser.add_argument('--format',
+                    default='BagpipeMusicWriter')
+    parser.add_argument('--write',
+                    nargs='?',
+                    const='',
+                    metavar='PATH',
+                    help="Save the learned order, by default next to the parser definition so it is used from then on")
+    parser.add_argument('filenames',
+                    nargs='+')
+    return parser.parse_args()
+
+def main():
+    from bpmusictransposer.musicparser import MusicParser
+    arguments = parseargs()
+    parser = MusicParser.parsers[arguments.format]
+    parser.collect_matcher_stats()
+    for filename in arguments.filenames:
+        with open(filename, encoding=parser.encoding) as file:
+            for token in parser.iter_tokens(file):
+                pass
+    for row in sorted(parser.matcher_report(), key=lambda x: -x["hits"]):
+        print("%-28s %8d hits %8d tries %6.1f%%" % (row["target"], row["hits"], row["tries"], 100 * row["hit_rate"]))
+    if arguments.write is not None:
+        parser.learn_matcher_order()
+        path = parser.save_matcher_order(arguments.write or None)
+        print("Saved matcher order to %s" % path, file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+from threading import Lock, local
+from contextlib import contextmanager
+from time import perf_counter
+from collections import Counter
+from operator import attrgetter
+
+prefix = "bpmusictransposer"
+
+class Histogram:
+    def observe(self, value):
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for (i, count) in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Cumulative, as Prometheus reports them
+        self.counts = [0 for x in buckets]
+        self.count = 0
+        self.sum = 0.0
+
+class Metrics:
+    """Counters, histograms, gauges and stage timers for the conversion pipeline
+
+    Nothing is recorded until enable() is called. Stage time is exclusive: while a nested stage
+    runs on the same thread (tokenize pulling lines through preprocess, say), the outer one
+    is paused, so the stages of a run add up to its wall time."""
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def describe(self, name, kind, description):
+        self.descriptions[name] = (kind, description)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.default_buckets)
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, function, description="", label="status", kind="gauge"):
+        """Report function() when scraped, a number or a dict of label value -> number
+
+        kind is the Prometheus type, a counter kept elsewhere can be reported as one too."""
+        self.gauges[name] = (function, label)
+        self.describe(name, kind, description)
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def _enter(self, name):
+        stack = self._stack()
+        now = perf_counter()
+        if stack:
+            stack[-1][1] += now - stack[-1][2]
+        entry = [name, 0.0, now]
+        stack.append(entry)
+        return entry
+
+    def _exit(self, entry):
+        stack = self._stack()
+        now = perf_counter()
+        stack.pop()
+        self.inc("stage_seconds_total", entry[1] + now - entry[2], stage=entry[0])
+        if stack:
+            stack[-1][2] = now
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        entry = self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit(entry)
+
+    def timed(self, name, iterable):
+        """Iterate, counting the time spent producing each item to stage name"""
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iter(iterable))
+
+    def _timed(self, name, iterator):
+        while True:
+            entry = self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit(entry)
+            yield item
+
+    def timed_writer(self, name, fp):
+        if not self.enabled:
+            return fp
+        return TimedWriter(self, name, fp)
+
+    def count_tokens(self, tokens):
+        """Count a finished list of tokens by type"""
+        if not self.enabled:
+            return
+        for (note_type, count) in Counter(map(attrgetter("note_type"), tokens)).items():
+            self.inc("tokens_total", count, type=note_type)
+
+    def take(self):
+        """Counters and histograms recorded so far, which are then cleared, to merge into another process's metrics"""
+        with self.lock:
+            taken = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return taken
+
+    def merge(self, taken):
+        (counters, histograms) = taken
+        with self.lock:
+            for (key, value) in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (key, histogram) in histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(histogram.buckets)
+                self.histograms[key].merge(histogram)
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in labels)
+
+    def prometheus(self):
+        """Everything recorded, in the Prometheus text exposition format"""
+        lines = []
+        def header(name, kind):
+            description = self.descriptions.get(name, (kind, ""))[1]
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+        seen = set()
+        for ((name, labels), value) in counters:
+            if name not in seen:
+                header(name, "counter")
+                seen.add(name)
+            lines.append("%s_%s%s %s" % (prefix, name, self._labels(labels), value))
+        for ((name, labels), histogram) in histograms:
+            if name not in seen:
+                header(name, "histogram")
+                seen.add(name)
+            for (bound, count) in zip(histogram.buckets, histogram.counts):
+                lines.append("%s_%s_bucket%s %d" % (prefix, name, self._labels(labels, [("le", bound)]), count))
+            lines.append("%s_%s_bucket%s %d" % (prefix, name, self._labels(labels, [("le", "+Inf")]), histogram.count))
+            lines.append("%s_%s_sum%s %s" % (prefix, name, self._labels(labels), histogram.sum))
+            lines.append("%s_%s_count%s %d" % (prefix, name, self._labels(labels), histogram.count))
+        for (name, (function, label)) in sorted(self.gauges.items()):
+            header(name, self.descriptions[name][0])
+            value = function()
+            if isinstance(value, dict):
+                for (label_value, count) in sorted(value.items()):
+                    lines.append("%s_%s%s %s" % (prefix, name, self._labels([(label, label_value)]), count))
+            else:
+                lines.append("%s_%s %s" % (prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Stage times and token counts as a short human readable table"""
+        with self.lock:
+            stages = {dict(labels)["stage"]: value for ((name, labels), value) in self.counters.items() if name == "stage_seconds_total"}
+            tokens = sum(value for ((name, labels), value) in self.counters.items() if name == "tokens_total")
+        total = sum(stages.values()) or 1
+        lines = ["%-12s %10s %6s" % ("stage", "seconds", "share")]
+        for (stage, seconds) in sorted(stages.items(), key=lambda x: -x[1]):
+            lines.append("%-12s %10.4f %5.1f%%" % (stage, seconds, 100 * seconds / total))
+        lines.append("%d tokens" % tokens)
+        return "\n".join(lines)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        self.local = local()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.descriptions = {}
+        self.describe("stage_seconds_total", "counter", "Seconds spent in each conversion stage")
+        self.describe("tokens_total", "counter", "Tokens of the tunes parsed, by type")
+        self.describe("render_run_seconds", "histogram", "Duration of each lilypond run")
+        self.describe("renders_total", "counter", "Files rendered, by result")
+        self.describe("job_seconds", "histogram", "Time from upload until a job completes or fails")
+        self.describe("jobs_total", "counter", "Finished jobs, by status")
+        self.describe("tune_cache_total", "counter", "Parsed tune cache lookups, by result")
+
+class TimedWriter:
+    """File object wrapper counting the time spent in write() to a stage"""
+
+    def write(self, text):
+        entry = self.metrics._enter(self.name)
+        try:
+            return self.fp.write(text)
+        finally:
+            self.metrics._exit(entry)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def __init__(self, metrics, name, fp):
+        self.metrics = metrics
+        self.name = name
+        self.fp = fp
+
+# Shared by the whole process
+metrics = Metrics()
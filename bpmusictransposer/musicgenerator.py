@@ -1,8 +1,34 @@
-from functools import reduce
-from itertools import islice
-import sys
+from fractions import Fraction
+from inspect import isfunction
+from contextlib import contextmanager
+import os, sys, io, secrets
 from jinja2 import Template, Environment, PackageLoader
 from bpmusictransposer.logger import Logger
+from bpmusictransposer.metrics import metrics
+
+@contextmanager
+def open_output(filename):
+    '''Open a new file to write LilyPond to, which only appears as filename once the block finishes without error
+
+    Like open(filename, 'x') it refuses to replace an existing file, but a generator failing part
+    way leaves nothing behind to block the next attempt or be served as a result.'''
+    if os.path.exists(filename):
+        raise FileExistsError("File exists: '%s'" % filename)
+    (directory, name) = os.path.split(filename)
+    partial = os.path.join(directory, ".%s.%s" % (name, secrets.token_hex(8)))
+    # Created like open() would, mode 0666 less the umask, where tempfile's are always 0600
+    with os.fdopen(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), 'w') as file:
+        try:
+            yield file
+        except BaseException:
+            file.close()
+            os.unlink(partial)
+            raise
+    try:
+        # link, unlike rename, won't replace a file made meanwhile
+        os.link(partial, filename)
+    finally:
+        os.unlink(partial)
 
 class MusicGenerator:
     logger = Logger()
@@ -133,6 +159,23 @@ class MusicGenerator:
             raise AttributeError("'%s' has no attribute '%s'" % (self.__class__.__name__, name))
         return method
 
+    @classmethod
+    def _dispatch_table(cls):
+        '''Note type -> unbound handler, built once per class. Methods win over the translations, as with __getattr__'''
+        if "_dispatch_functions" not in vars(cls):
+            functions = {}
+            for (name, value) in cls.simple_translation.items():
+                functions[name] = lambda self, *args, value=value, **modifiers: value
+            for klass in reversed(cls.__mro__):
+                for (name, value) in vars(klass).items():
+                    if isfunction(value) and not name.startswith("__"):
+                        functions[name] = value
+            for (name, target) in cls.func_translation.items():
+                if name not in functions:
+                    functions[name] = lambda self, *args, target=functions[target], name=name, **modifiers: target(self, name, *args, **modifiers)
+            cls._dispatch_functions = functions
+        return cls._dispatch_functions
+
     def build_zipped_embellishment(self, notes):
         self.prev_note = ""
         return "%s\grace { %s }" % (self._get_indent(), ' '.join(map(lambda x : "%s%d" % x, notes)))
@@ -466,55 +509,65 @@ class MusicGenerator:
                 fname = note.note_type
                 fargs = note.ordered_arguments
                 fkwargs = note.modifiers
+            handler = self._dispatch.get(fname)
+            if not handler:
+                raise AttributeError("'%s' has no attribute '%s'" % (self.__class__.__name__, fname))
             if not isinstance(fargs, list):
-                return getattr(self, fname)(fargs)
+                return handler(fargs)
             if fkwargs:
-                return getattr(self, fname)(*fargs, **fkwargs)
-            return getattr(self, fname)(*fargs)
+                return handler(*fargs, **fkwargs)
+            return handler(*fargs)
         except Exception as e:
             raise Exception("%s in %s with *%s **%s" % (str(e), fname, fargs, fkwargs))
 
 
-    def _find_offset(self, time, notes, note_offset=0, simple_opt="partial"):
+    def _note_length(self, note):
+        'Length of a note as a fraction of a whole note, including any dots and the tuplet it is in'
+        base_value = Fraction(1, int(note.get_args()[1]))
+        result = base_value
+        if "dot" in note.modifiers:
+            temp_val = base_value
+            for x in range(note.modifiers["dot"]):
+                temp_val = temp_val / 2
+                result += temp_val
+        if "tuplet" in note.modifiers:
+            # count notes in the time of time_notes, as \tuplet count/time plays them
+            (count, time_notes) = note.modifiers["tuplet"]
+            result = result * int(time_notes) / int(count)
+        return result
+
+    def _measure_bars(self, notes):
+        'For every position, the length of the notes from there up to the end of that bar, in one pass from the end'
+        result = [Fraction(0)] * (len(notes) + 1)
+        for i in range(len(notes) - 1, -1, -1):
+            note_type = notes[i].get_type()
+            if note_type == 'note':
+                result[i] = result[i + 1] + self._note_length(notes[i])
+            elif not note_type.endswith('end'):
+                result[i] = result[i + 1]
+        return result
+
+    def _find_offset(self, time, position, simple_opt="partial"):
         time_count = time[0]
         time_denom = time[1]
-        
-        first_bar_index = 0
-        prebar_notes = []
-        for i, note in enumerate(notes):
-            if note.get_type() == 'note':
-                prebar_notes.append(note)
-            elif note.get_type().endswith('end'):
-                first_bar_index = i
-                break
-
-        def set_weight(note):
-            note_denom = int(note.get_args()[1])
-            base_value = time_denom / note_denom
-            addl_value = 0
-            if "dot" in note.modifiers:
-                temp_val = base_value
-                for x in range(note.modifiers["dot"]):
-                    addl_value += 0.5 * temp_val
-                    temp_val = temp_val / 2
-            return base_value + addl_value
-
-        prebar_count = reduce(lambda acc, x: acc + set_weight(x), prebar_notes, 0)
-
-        offset = time_count - prebar_count
+
+        prebar_count = self._bar_lengths[position] * time_denom
+
+        # An overfull bar is still taken to start on the beat
+        offset = max(time_count - prebar_count, 0)
 
         offset_time_denom = time_denom
 
-        if prebar_count != 0 and (time_denom / prebar_count).is_integer():
-            return "\%s %d" % (simple_opt, (time_denom / prebar_count))
+        if prebar_count != 0 and (time_denom / prebar_count).denominator == 1:
+            return "\\%s %d" % (simple_opt, int(time_denom / prebar_count))
 
-        while offset > 1 and not float(offset).is_integer():
+        while offset > 1 and offset.denominator != 1:
             offset *=2
             offset_time_denom *= 2
-        
+
         self.logger.log("New offset {%f/%f}" % (offset, offset_time_denom), 3)
 
-        return "\set Timing.measurePosition = #(ly:make-moment %d/%d)" % (offset, offset_time_denom)
+        return "\\set Timing.measurePosition = #(ly:make-moment %d/%d)" % (int(offset), offset_time_denom)
 
     def _generate_header(self, tune):
         return """
@@ -523,38 +576,81 @@ class MusicGenerator:
         """ % (tune.title, tune.composer)
 
     def _generate_music(self, tune):
+        'Yield the LilyPond fragments for the notes of a tune in order'
         self.prev_note = ""
-        result = []
         for i in range(0, len(tune.notes)):
             note = tune.notes[i]
             if not note or note == '' or note == "_ignore":
                 continue
             if response := self._decode(note):
-                result.append(response)
                 if self.embellishment_fix:
-                    result.append("%s\override Stem.direction = -1%s" % (self._get_indent(), self._get_indent()))
+                    yield response
+                    yield "%s\\override Stem.direction = -1%s" % (self._get_indent(), self._get_indent())
                     self.embellishment_fix = False
                     self.stem_reversed = True
-                if not self.stem_reversed and self.prev_note:
-                    result.insert(-1, "%s\override Stem.direction = -1%s" % (self._get_indent(), self._get_indent()))
+                elif not self.stem_reversed and self.prev_note:
+                    yield "%s\\override Stem.direction = -1%s" % (self._get_indent(), self._get_indent())
+                    yield response
                     self.stem_reversed = True
+                else:
+                    yield response
                 if note.note_type in ["repeatstart", "partstart", "time_notation"]:
-                    time = self._curr_time
                     if note.note_type == "time_notation":
                         self._curr_time = tuple([int(t) for t in note.ordered_arguments])
-                    if new_offset := self._find_offset(time, islice(tune.notes, i + 1, None)):
+                    # A bar after a time change is measured in the new time
+                    if new_offset := self._find_offset(self._curr_time, i + 1):
                         self.offset = new_offset
-        return "".join(result)
 
-    def from_tune(self, tune):
+    def _split_template(self, template):
+        'Render the template once around markers, giving the text before the header, between header and music, and after the music'
+        markers = {"header": "\\0header\\0", "music": "\\0music\\0"}
+        rendered = template.render(markers)
+        (before_header, rest) = rendered.split(markers["header"])
+        (before_music, after_music) = rest.split(markers["music"])
+        return (before_header, before_music, after_music)
+
+    def _write_score(self, tune, fp, before_header):
         self.__reset__()
         header = self._generate_header(tune)
         self._curr_time = tune.time
         if self._curr_time == (0,0):
             self._curr_time = (4,4)
-        self.offset = self._find_offset(self._curr_time, tune.notes)
-        music = self._generate_music(tune)
-        return self.template.render({"header": header, "music": music})
+        self._bar_lengths = self._measure_bars(tune.notes)
+        self.offset = self._find_offset(self._curr_time, 0)
+        (_, before_music, after_music) = self.template_parts
+        fp.write(before_header)
+        fp.write(header)
+        fp.write(before_music)
+        for fragment in self._generate_music(tune):
+            fp.write(fragment)
+        fp.write(after_music)
+
+    def write_tune(self, tune, fp):
+        'Write a tune as LilyPond to the file object fp, fragment by fragment'
+        self.write_book([tune], fp)
+
+    def write_book(self, tunes, fp, suffixes=None):
+        '''Write several tunes as one LilyPond file, a \\score for each
+
+        Given suffixes, each score gets its own \\book with that \\bookOutputSuffix, so a single
+        lilypond run writes a separate output (name-suffix.pdf) per tune'''
+        with metrics.stage("generate"):
+            fp = metrics.timed_writer("write", fp)
+            fp.write(self.preamble)
+            score_start = self.template_parts[0][len(self.preamble):]
+            marker = "\\0score\\0"
+            for (i, tune) in enumerate(tunes):
+                if suffixes:
+                    (book_start, book_end) = self.book_template.render({"suffix": suffixes[i], "score": marker}).split(marker)
+                    fp.write(book_start)
+                self._write_score(tune, fp, score_start)
+                if suffixes:
+                    fp.write(book_end)
+
+    def from_tune(self, tune):
+        result = io.StringIO()
+        self.write_tune(tune, result)
+        return result.getvalue()
 
     def __reset__(self):
         self.prev_note = ""
@@ -570,5 +666,9 @@ class MusicGenerator:
     def __init__(self):
         self.__reset__()
         self._indent_spaces = 4
+        self._dispatch = {name: function.__get__(self) for (name, function) in self._dispatch_table().items()}
         jinja_env = Environment(loader = PackageLoader('bpmusictransposer', 'templates'))
         self.template = jinja_env.get_template("base.ly.jinja")
+        self.template_parts = self._split_template(self.template)
+        self.preamble = jinja_env.get_template("preamble.ly.jinja").render()
+        self.book_template = jinja_env.get_template("book.ly.jinja")
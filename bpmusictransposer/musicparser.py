@@ -1,45 +1,216 @@
-import re, json, os
+import re, json, os, sys, hashlib
 from bpmusictransposer.tune import Tune
 from bpmusictransposer.notetoken import NoteToken
 from bpmusictransposer.logger import Logger
+from bpmusictransposer.metrics import metrics
 from itertools import takewhile, islice
+from collections import deque, OrderedDict
+from threading import Lock
 from importlib import resources as impresources
-from . import parserdefs
+from . import parserdefs, matcherorder
 from functools import partial
+from operator import methodcaller
+
+class ParserRegistry(dict):
+    '''Parsers by format name, definitions are only loaded on the first lookup'''
+    def __missing__(self, key):
+        if not self:
+            load_parsers()
+            if key in self:
+                return self[key]
+        raise KeyError(key)
+
+class Alternative:
+    '''Where one matcher's groups sit in a combined matcher's pattern'''
+
+    def __init__(self, combinedre, position):
+        outer = combinedre.groupindex["_%d" % position]
+        following = combinedre.groupindex.get("_%d" % (position + 1), combinedre.groups + 1)
+        prefix = "_%d_" % position
+        self.names = [(name[len(prefix):], index - outer - 1) for (name, index) in combinedre.groupindex.items()
+                if outer < index < following]
+        self.prefix = prefix
+        # Reads this alternative's own groups from a combined match, without the tuple of every group groups() makes
+        indices = range(outer + 1, following)
+        if not indices:
+            self.read = lambda found: ()
+        elif len(indices) == 1:
+            self.read = lambda found: (found.group(outer + 1),)
+        else:
+            self.read = methodcaller("group", *indices)
+
+class AlternativeMatch:
+    '''The part of a combined match made by one alternative, read as a match of that matcher alone
+
+    Offers what NoteToken.read_arguments uses, so handlers get their groups without matching again.
+    re is the Alternative, one per matcher, so it keys argument schemas like a pattern would.'''
+    __slots__ = ("found", "re", "values")
+
+    def groups(self):
+        return self.values
+
+    def groupdict(self):
+        values = self.values
+        return {name: values[offset] for (name, offset) in self.re.names}
+
+    def span(self, name):
+        return self.found.span(self.re.prefix + name)
+
+    def __init__(self, found, alternative):
+        self.found = found
+        self.re = alternative
+        self.values = alternative.read(found)
+
+class PendingTokens:
+    '''Tokens _token_parse has not yielded yet, with those of each indexed type kept in order
+
+    Apply handlers and the settled check look tokens up by type here instead of scanning
+    everything pending, so they cost the same however far back the last match was.'''
+
+    def append(self, token):
+        self.tokens.append(token)
+        if isinstance(token, NoteToken) and token.note_type in self.by_type:
+            self.by_type[token.note_type].append(token)
+
+    def popleft(self):
+        token = self.tokens.popleft()
+        if isinstance(token, NoteToken) and token.note_type in self.by_type:
+            self.by_type[token.note_type].popleft()
+        return token
+
+    def of_type(self, note_type):
+        '''Pending tokens of an indexed type, oldest first'''
+        return self.by_type[note_type]
+
+    def last(self):
+        return self.tokens[-1] if self.tokens else None
+
+    def __getitem__(self, i):
+        return self.tokens[i]
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __init__(self, types):
+        self.tokens = deque()
+        self.by_type = {note_type: deque() for note_type in types}
 
 class MusicParser:
     argument_re = re.compile('{{([^}]*)}}')
+    group_name_re = re.compile(r'(?<!\\)\(\?P<')
     logger = Logger()
-
-    parsers = {}
+    # Tokens that can come before the music of a tune
+    header_types = ["title", "tunetype", "composer", "tempo", "footer"]
+    # Header tokens get_tune_header sets on the Tune
+    header_values = ["title", "tunetype", "composer", "tempo"]
+    # Counts read from a token's arguments ({{count}}) are a single digit
+    max_apply_count = 9
+    # Distinct token strings whose parsed tokens are kept for reuse
+    token_cache_size = 4096
+
+    parsers = ParserRegistry()
     
     def set_loglevel(self, level):
         logger.set_loglevel(level)
 
     def get_tune_from_file(self, filename):
         with open(filename, encoding=self.encoding) as file:
-            tunestr = file.read()
-        return self.get_tune(tunestr)
+            return self.get_tune_from_stream(file)
 
     def get_tune(self, musicstr):
+        return self.get_tune_from_stream(musicstr.split("\n"))
+
+    def get_tune_from_stream(self, stream):
+        return self._tune_from_notes(list(self.iter_tokens(stream)))
+
+    def get_tune_header_from_file(self, filename):
+        with open(filename, encoding=self.encoding) as file:
+            return self.get_tune_header_from_stream(file)
+
+    def get_tune_header(self, musicstr):
+        return self.get_tune_header_from_stream(musicstr.split("\n"))
+
+    def get_tune_header_from_stream(self, stream):
+        '''A Tune with its header values and time but no notes, reading no further than the first time signature'''
+        result = Tune()
+        header = {}
+        lines = (line.rstrip("\n") for line in stream)
+        for note in self._preprocess_parse(lines):
+            if isinstance(note, NoteToken):
+                if note.note_type in self.header_values and note.note_type not in header:
+                    header[note.note_type] = note
+                continue
+            for token in note.split():
+                # Apply handlers only change the tokens before them, skip them
+                toadd = self._parse_token(token)
+                if isinstance(toadd, NoteToken) and toadd.note_type == "time_notation":
+                    self._set_header(result, header)
+                    self._set_time(result, toadd)
+                    return result
+        self._set_header(result, header)
+        return result
+
+    def iter_tunes(self, stream):
+        '''Yield a Tune for each tune in a stream, a title after any music starts the next one'''
+        notes = []
+        has_music = False
+        for token in self.iter_tokens(stream):
+            if token.note_type == "title" and has_music:
+                yield self._tune_from_notes(notes)
+                notes = []
+                has_music = False
+            notes.append(token)
+            has_music = has_music or token.note_type not in self.header_types
+        if notes:
+            yield self._tune_from_notes(notes)
+
+    def _tune_from_notes(self, notes):
+        metrics.count_tokens(notes)
         result = Tune()
-        result.notes = self.parse(musicstr)
+        result.notes = notes
         header = self._process_first_and_remove(["title", "tunetype", "composer"], result)
         result.set_values(header)
         time = self._find_first("time_notation", result)
         if time:
-            time_parts = time.get_args()
-            result.time = (int(time_parts[0]), int(time_parts[1]))
+            self._set_time(result, time)
+        # Left in the notes, the generator writes it out
+        tempo = self._find_first("tempo", result)
+        if tempo:
+            self._set_tempo(result, tempo)
         return result
 
+    def _set_header(self, tune, header):
+        tempo = header.pop("tempo", None)
+        tune.set_values(header)
+        if tempo:
+            self._set_tempo(tune, tempo)
+
+    def _set_time(self, tune, time):
+        time_parts = time.get_args()
+        tune.time = (int(time_parts[0]), int(time_parts[1]))
+
+    def _set_tempo(self, tune, tempo):
+        try:
+            tune.tempo = int(tempo.get_args()[0])
+        except ValueError:
+            # Not a number, the tune keeps no tempo
+            pass
+
     def parse(self, musicstr):
-        notes = musicstr.split("\n")
-        notes = self._preprocess_parse(notes)
-        notes = self._token_parse(notes)
-        return notes
+        return list(self.iter_tokens(musicstr.split("\n")))
+
+    def iter_tokens(self, stream):
+        '''Yield NoteTokens from an iterable of lines (e.g. an open file) as soon as they are settled'''
+        lines = (line.rstrip("\n") for line in metrics.timed("read", stream))
+        preprocessed = metrics.timed("preprocess", self._preprocess_parse(lines))
+        # Timed a line at a time, a stage switch for every token costs more than the tokenizing
+        for settled in metrics.timed("tokenize", self._token_parse(preprocessed)):
+            yield from settled
 
     def _preprocess_parse(self, notes):
-        result = []
         fixre = re.compile("[\[{(][^\]})]*$")
         fixing = ""
         def needs_fix(part):
@@ -58,57 +229,78 @@ class MusicParser:
             elif needs_fix(note):
                 fixing += note
                 continue
-            for (target, matcher) in self.preprocess_matchers:
-                if matched := matcher(toadd):
-                    toadd = self.preprocess_handlers[target](matched)
-                    break
+            if found := self.preprocess_matcher(toadd):
+                (target, matched) = found
+                toadd = self.preprocess_handlers[target](matched)
             if toadd:
-                result.append(toadd)
-        return result
+                yield toadd
+
+    def _is_settled(self, pending):
+        '''The oldest pending token is settled once no later apply handler can reach back to it'''
+        first = pending[0]
+        if not isinstance(first, NoteToken) or first.note_type not in self.apply_windows:
+            return True
+        # first is the oldest of its type, the rest of them came after it
+        return len(pending.of_type(first.note_type)) - 1 >= self.apply_windows[first.note_type]
 
     def _token_parse(self, notes):
-        tokens = []
+        '''Yield a list of the tokens settled by each note, then one of those still pending at the end'''
+        pending = PendingTokens(self.apply_windows)
         for note in notes:
-            if isinstance(note, str):
-                tokens += note.split()
-            else:
-                tokens.append(note)
-
-        result = []
-        reparse = []
-        for (i, token) in enumerate(tokens):
-            toadd = token
-            if isinstance(token, str):
-                for (target, matcher) in self.parser_matchers:
-                    if match := matcher(token):
-                        toadd = self.parser_handlers[target](match)
-                        break
-            if callable(toadd):
-                toadd = toadd(result)
-            if toadd:
-                if isinstance(toadd, str):
-                    reparse.append(len(result))
-                result.append(toadd)
-        return self._compound_token_parse(result, reparse)
-
-    def _compound_token_parse(self, notes, indices):
-        result = notes
-        for i in reversed(indices):
-            next = result.pop(i)
-        return result
+            tokens = note.split() if isinstance(note, str) else [note]
+            settled = []
+            for token in tokens:
+                toadd = token
+                if isinstance(token, str):
+                    toadd = self._parse_token(token)
+                if callable(toadd):
+                    toadd = toadd(pending)
+                if toadd:
+                    pending.append(toadd)
+                    while pending and self._is_settled(pending):
+                        settled.append(pending.popleft())
+            if settled:
+                yield settled
+        yield list(pending)
+
+    def _parse_token(self, token):
+        '''The NoteToken (or apply callable) for one token string
+
+        A string that parses to a plain NoteToken is kept in an LRU cache, later occurrences get
+        a copy of it instead of being matched again. Apply handlers depend on the tokens around
+        them so their results are never kept, and nothing is cached while counting matcher hits.'''
+        if self.matcher_stats is None:
+            with self.token_cache_lock:
+                cached = self.token_cache.get(token)
+                if cached is not None:
+                    self.token_cache.move_to_end(token)
+            if cached is not None:
+                return cached.copy()
+        toadd = None
+        if found := self.parser_matcher(token):
+            (target, match) = found
+            toadd = self.parser_handlers[target](match)
+        if isinstance(toadd, NoteToken) and self.matcher_stats is None:
+            with self.token_cache_lock:
+                self.token_cache[token] = toadd.copy()
+                while len(self.token_cache) > self.token_cache_size:
+                    self.token_cache.popitem(last=False)
+        return toadd
 
     def _process_first_and_remove(self, keys, tune):
-        to_find = keys
-        remove = []
+        '''Take the first token of each type in keys out of the tune, in one pass'''
+        to_find = set(keys)
         result = {}
-        for (i, note) in enumerate(tune.notes):
-            if note.note_type in to_find:
+        kept = []
+        for note in tune.notes:
+            if to_find and note.note_type in to_find:
                 to_find.remove(note.note_type)
                 result[note.note_type] = note
-                remove.append(i)
-        for i in reversed(remove):
-            tune.notes.pop(i)
+            else:
+                kept.append(note)
+        tune.notes = kept
         return result
+
     def _find_first(self, key, tune):
         for (i, note) in enumerate(tune.notes):
             if key == note.get_type():
@@ -163,32 +355,36 @@ class MusicParser:
             return result
         return handle
 
-    def _build_modifier_handler(self, modifiers):
-        def omnihandle(note):
-            result = {}
-            for (k,v) in modifiers.items():
-                if isinstance(v, list):
-                    if v[0] == "_!f":
-                        result[k] = globals()[v[1]][v[2]](note.keyword_arguments[v[3]])
-                    else:
-                        result[k] = [note.keyword_arguments[key] for key in v]
-                elif isinstance(v, dict):
-                    arg = note.keyword_arguments.get(k, None)
-                    if arg:
-                        result[k] = modifiers[k][arg]
-                    else:
-                        result[k] = arg
-                else:
-                    result[k] = v
-            note.add_modifiers(result)
-            return note
-        return omnihandle
-
-    def _build_type_handler(self, mutate):
-        def typehandle(note):
-            note.set_note_type(mutate)
+    def _modifier_getter(self, key, spec):
+        '''A function of a token's keyword arguments giving the value of one modifier spec entry'''
+        if isinstance(spec, list) and spec[0] == "_!f":
+            # ["_!f", namespace, function, argument]
+            namespace = globals()[spec[1]]
+            function = namespace[spec[2]] if isinstance(namespace, dict) else getattr(namespace, spec[2])
+            argument = spec[3]
+            return lambda kwargs: function(kwargs[argument])
+        if isinstance(spec, list):
+            keys = tuple(spec)
+            return lambda kwargs: [kwargs[k] for k in keys]
+        if isinstance(spec, dict):
+            return lambda kwargs: spec[kwargs[key]] if kwargs.get(key, None) else kwargs.get(key, None)
+        return lambda kwargs: spec
+
+    def _build_modifier_handler(self, specs):
+        '''Add the modifiers of every spec in specs to a token, later specs overriding earlier ones'''
+        items = [(k, v) for spec in specs for (k, v) in spec.items()]
+        if not any(isinstance(v, (list, dict)) for (k, v) in items):
+            constant = dict(items)
+            def add_constant(note):
+                note.add_modifiers(constant)
+                return note
+            return add_constant
+        getters = tuple((k, self._modifier_getter(k, v)) for (k, v) in items)
+        def add_modifiers(note):
+            kwargs = note.keyword_arguments
+            note.add_modifiers({k: getter(kwargs) for (k, getter) in getters})
             return note
-        return typehandle
+        return add_modifiers
 
     def _build_mutate_handler(self, mutate):
         def default(token):
@@ -196,7 +392,7 @@ class MusicParser:
                 token.set_arg(key, value)
             return token
         def order(token):
-            token.set_order(token.mutate["order"])
+            token.set_order(mutate["order"])
             return token
         f = lambda x : x
         if "default" in mutate:
@@ -211,30 +407,29 @@ class MusicParser:
             return note
         return set_args
 
-    def _is_when(self, target, when):
-        result = True
-        for (k, v) in when.items():
-            result = result and target.modifiers[k] == v
-        return result
-
     def _build_apply_handler(self, apply):
-        def prevn(count, apply_token, notes):
-            if "when" not in apply or self._is_when(apply_token, apply["when"]):
-                applied = 0
-                for i in range(-1, -len(notes), -1):
-                    if isinstance(notes[i], NoteToken) and notes[i].note_type == apply["target"]:
-                        notes[i].add_modifiers(apply_token.modifiers)
-                        applied += 1
-                    if applied >= count:
-                        break
-            return apply_token if "return" in apply and apply["return"] else None
-
-        def apply_handler(token):
-            count = apply["prevn"]
-            if isinstance(count, str):
-                count = int(token.keyword_arguments[count])
-            return partial(prevn, count, token)
-        return apply_handler
+        window = apply["prevn"] if isinstance(apply["prevn"], int) else self.max_apply_count
+        self.apply_windows[apply["target"]] = max(window, self.apply_windows.get(apply["target"], 0))
+
+        target = apply["target"]
+        when = tuple(apply.get("when", {}).items())
+        returns = bool(apply.get("return", False))
+        def prevn(count, apply_token, pending):
+            if all(apply_token.modifiers[k] == v for (k, v) in when):
+                if count < 1:
+                    # Only reaches the token right before
+                    last = pending.last()
+                    targets = [last] if isinstance(last, NoteToken) and last.note_type == target else []
+                else:
+                    targets = islice(reversed(pending.of_type(target)), count)
+                for note in targets:
+                    note.add_modifiers(apply_token.modifiers)
+            return apply_token if returns else None
+
+        count = apply["prevn"]
+        if isinstance(count, str):
+            return lambda token: partial(prevn, int(token.keyword_arguments[count]), token)
+        return lambda token: partial(prevn, count, token)
 
     def _compose(self, f, g):
         return lambda x : f(g(x))
@@ -254,13 +449,115 @@ class MusicParser:
         return composed
 
     def _build_simple_matcher(self, pattern):
-        patternre = re.compile(pattern)
+        patternre = None
         def match(tocheck, complete=True):
+            nonlocal patternre
+            if not patternre:
+                patternre = re.compile(pattern)
             if complete:
                 return patternre.fullmatch(tocheck)
             return patternre.search(tocheck)
+        match.pattern = pattern
         return match
 
+    def _build_combined_matcher(self, matchers, stats=None):
+        '''Join (target, matcher) pairs into a single alternation, first match in list order wins
+
+        Given stats, the winning position of each match is counted in stats["hits"], and tokens
+        nothing matched in stats["unmatched"]'''
+        if not matchers:
+            return lambda tocheck: None
+        alternatives = []
+        for (i, (target, matcher)) in enumerate(matchers):
+            pattern = self.group_name_re.sub("(?P<_%d_" % i, matcher.pattern)
+            alternatives.append("(?P<_%d>%s)" % (i, pattern))
+        # (regex, outer group name -> (position, target, Alternative)), published whole once built
+        compiled = None
+        compile_lock = Lock()
+        def compile_combined():
+            nonlocal compiled
+            with compile_lock:
+                if compiled is None:
+                    combinedre = re.compile("|".join(alternatives))
+                    by_group = {"_%d" % i: (i, target, Alternative(combinedre, i)) for (i, (target, matcher)) in enumerate(matchers)}
+                    compiled = (combinedre, by_group)
+            return compiled
+        def match(tocheck):
+            (combinedre, by_group) = compiled or compile_combined()
+            if found := combinedre.fullmatch(tocheck):
+                (position, target, alternative) = by_group[found.lastgroup]
+                return (target, AlternativeMatch(found, alternative))
+            return None
+        if stats is None:
+            return match
+        def counting_match(tocheck):
+            (combinedre, by_group) = compiled or compile_combined()
+            if found := combinedre.fullmatch(tocheck):
+                (position, target, alternative) = by_group[found.lastgroup]
+                stats["hits"][position] += 1
+                return (target, AlternativeMatch(found, alternative))
+            stats["unmatched"] += 1
+            return None
+        return counting_match
+
+    # Matcher order
+    def collect_matcher_stats(self, enabled=True):
+        '''Count which parser matcher wins each token from now on, see matcher_report'''
+        self.matcher_stats = { "hits": [0 for x in self.parser_matchers], "unmatched": 0 } if enabled else None
+        self.parser_matcher = self._build_combined_matcher(self.parser_matchers, self.matcher_stats)
+
+    def matcher_report(self):
+        '''Hits of each parser matcher in the order they are tried, with how often each was tried at all'''
+        stats = self.matcher_stats
+        tries = sum(stats["hits"]) + stats["unmatched"]
+        report = []
+        for ((target, matcher), hits) in zip(self.parser_matchers, stats["hits"]):
+            report.append({ "target": target, "pattern": matcher.pattern, "hits": hits, "tries": tries, "hit_rate": hits / tries if tries else 0 })
+            tries -= hits
+        return report
+
+    def matcher_hits(self):
+        '''Tokens won by each target since collect_matcher_stats, adding up the matchers of a target'''
+        hits = {}
+        for ((target, matcher), count) in zip(self.parser_matchers, self.matcher_stats["hits"]):
+            hits[target] = hits.get(target, 0) + count
+        return hits
+
+    def _matcher_key(self, matchers):
+        return hashlib.sha256(json.dumps([(target, matcher.pattern) for (target, matcher) in matchers]).encode()).hexdigest()
+
+    def _set_matcher_order(self, order):
+        self.parser_matchers = [self.parser_matchers[i] for i in order]
+        if self.matcher_stats:
+            self.matcher_stats["hits"] = [self.matcher_stats["hits"][i] for i in order]
+        self.parser_matcher = self._build_combined_matcher(self.parser_matchers, self.matcher_stats)
+
+    def learn_matcher_order(self):
+        '''Try the most hit parser matchers first, keeping the order of any two that can match the same token'''
+        patterns = [matcher.pattern for (target, matcher) in self.parser_matchers]
+        self._set_matcher_order(matcherorder.order_by_hits(patterns, self.matcher_stats["hits"]))
+
+    def save_matcher_order(self, path=None):
+        path = path or self.order_path
+        positions = {id(matcher): i for (i, (target, matcher)) in enumerate(self.definition_matchers)}
+        with open(path, 'w') as file:
+            json.dump({
+                "definitions": self._matcher_key(self.definition_matchers),
+                "order": [positions[id(matcher)] for (target, matcher) in self.parser_matchers]
+            }, file)
+        return path
+
+    def load_matcher_order(self, path):
+        '''Use a saved matcher order, unless the definitions changed since it was learned'''
+        with open(path) as file:
+            saved = json.load(file)
+        if saved["definitions"] != self._matcher_key(self.definition_matchers) or sorted(saved["order"]) != list(range(len(self.definition_matchers))):
+            print("Ignoring matcher order learned for other definitions: %s" % path, file=sys.stderr)
+            return False
+        self.parser_matchers = list(self.definition_matchers)
+        self._set_matcher_order(saved["order"])
+        return True
+
     def _build_arg_matcher(self, pattern, name=None, register=False):
         matchre = self._replace_arguments(pattern)
         if register and name and not name in self.internal_defs:
@@ -297,20 +594,51 @@ class MusicParser:
         for pattern in patterns:
             self._add_parser_matcher(self.parser_matchers, target, pattern)
 
+    def _compile_handler(self, definition, extra_modifiers=()):
+        '''One handler doing what a definition asks (type, mutate, args, modifiers, apply) for each match
+
+        Everything the definition decides is looked up here, once, the handler only runs the
+        steps it needs. extra_modifiers are the "modify" specs of _modifiers variants.'''
+        note_type = definition.get("type", definition["target"])
+        steps = []
+        if "mutate" in definition:
+            steps.append(self._build_mutate_handler(definition["mutate"]))
+        if "args" in definition:
+            steps.append(self._build_args_handler(definition["args"]))
+        modifier_specs = ([definition["modifiers"]] if "modifiers" in definition else []) + list(extra_modifiers)
+        if modifier_specs:
+            steps.append(self._build_modifier_handler(modifier_specs))
+        if "apply" in definition:
+            steps.append(self._build_apply_handler(definition["apply"]))
+        internal_defs = self.internal_defs
+        def ingest(match):
+            token = NoteToken(note_type)
+            token.read_arguments(match)
+            token.translate_arguments(internal_defs)
+            return token
+        if not steps:
+            return ingest
+        if len(steps) == 1:
+            (step,) = steps
+            def handle_one(match):
+                token = NoteToken(note_type)
+                token.read_arguments(match)
+                token.translate_arguments(internal_defs)
+                return step(token)
+            return handle_one
+        steps = tuple(steps)
+        def handle(match):
+            token = NoteToken(note_type)
+            token.read_arguments(match)
+            token.translate_arguments(internal_defs)
+            for step in steps:
+                token = step(token)
+            return token
+        return handle
+
     def _add_parser_handler(self, target, definition):
-        handled = ["Ingest"]
-        handlers = [
-            ("type", self._build_type_handler),
-            ("mutate", self._build_mutate_handler),
-            ("args", self._build_args_handler),
-            ("modifiers", self._build_modifier_handler),
-            ("apply", self._build_apply_handler)
-        ]
-        handler = self._build_ingest_handler(target)
-        for toapply in filter(lambda k : k[0] in definition, handlers):
-            handler = self._compose(toapply[1](definition[toapply[0]]), handler)
-            handled.append(toapply[0].capitalize())
-        self.parser_handlers[target] = handler
+        self.handler_definitions[target] = (definition, [])
+        self.parser_handlers[target] = self._compile_handler(definition)
 
     def _build_parser_defs(self, defs):
         defkey = "_parser_defs"
@@ -333,9 +661,10 @@ class MusicParser:
         return name
         
     def _add_modifier_handler(self, target, name, definition):
-        g = self.parser_handlers[target]
-        handler = self._compose(self._build_modifier_handler(definition["modify"]), g)
-        self.parser_handlers[name] = handler
+        (base, extra_modifiers) = self.handler_definitions[target]
+        extra_modifiers = extra_modifiers + [definition["modify"]]
+        self.handler_definitions[name] = (base, extra_modifiers)
+        self.parser_handlers[name] = self._compile_handler(base, extra_modifiers)
 
 
     def _build_modifier_defs(self, defs):
@@ -355,10 +684,15 @@ class MusicParser:
     def _load_parser(self, jsondef, register=False):
         defs = jsondef
         self.encoding = jsondef["_docstring"].get("Encoding", "utf-8")
+        # Part of the key of cached parse results
+        self.definitions_hash = hashlib.sha256(json.dumps(jsondef, sort_keys=True).encode()).hexdigest()
         self._build_internal_defs(defs)
         self._build_preprocess_defs(defs)
         self._build_parser_defs(defs)
         self._build_modifier_defs(defs)
+        self.preprocess_matcher = self._build_combined_matcher(self.preprocess_matchers)
+        self.parser_matcher = self._build_combined_matcher(self.parser_matchers)
+        self.definition_matchers = list(self.parser_matchers)
         if register:
             self.parsers[jsondef["_docstring"]["FormatName"]] = self
 
@@ -372,6 +706,13 @@ class MusicParser:
 
         self.parser_matchers = []
         self.parser_handlers = { "_": noop }
+        # Handler name -> (parser definition, modify specs of the _modifiers variants it is built from)
+        self.handler_definitions = {}
+        self.apply_windows = {}
+        self.matcher_stats = None
+        self.order_path = None
+        self.token_cache = OrderedDict()
+        self.token_cache_lock = Lock()
 
         self.parser_name = ""
         self.parser_extensions = []
@@ -382,14 +723,14 @@ def load_parsers():
     if not MusicParser.parsers:
         parsers = impresources.files(parserdefs)
         for parserfile in parsers.iterdir():
-            if parserfile.suffix == '.json':
-                parserjson = json.loads(parserfile.read_text())
-                MusicParser(parserjson, register=True)
+            if parserfile.suffix == '.json' and not parserfile.name.endswith('.order.json'):
                 try:
                     parserjson = json.loads(parserfile.read_text())
-                    MusicParser(parserjson, register=True)
+                    parser = MusicParser(parserjson, register=True)
+                    # Learned by bpmusictransposer.matcherorder
+                    parser.order_path = str(parserfile.with_name("%s.order.json" % parserfile.stem))
+                    if os.path.exists(parser.order_path):
+                        parser.load_matcher_order(parser.order_path)
                 except Exception as e:
                     print("Could not load parser definition: %s" % parserfile.name, file=sys.stderr)
                     print(e, file=sys.stderr)
-
-load_parsers()
@@ -1,23 +1,42 @@
+from types import MappingProxyType
+
+# Shared by every token that has no modifiers, replaced by a real dict on the first add_modifiers
+NO_MODIFIERS = MappingProxyType({})
+NO_INDICES = MappingProxyType({})
+
 class NoteToken:
+    __slots__ = ("note_type", "ordered_arguments", "keyword_arguments", "argument_indices", "modifiers")
+
+    # (pattern, unmatched groups) -> argument indices, shared by every token read from the same match shape
+    _argument_schemas = {}
+
     def set_note_type(self, typename):
         self.note_type = typename
 
+    def _argument_schema(self, match, groupdict):
+        key = (match.re, tuple(v is None for v in groupdict.values()))
+        if key not in self._argument_schemas:
+            ordered_group_names = [k for k in groupdict.keys()]
+            ordered_group_names.sort(key=lambda x: match.span(x)[0])
+            self._argument_schemas[key] = MappingProxyType({k: i for (i, k) in enumerate(ordered_group_names)})
+        return self._argument_schemas[key]
+
+    def _own_indices(self):
+        if isinstance(self.argument_indices, MappingProxyType):
+            self.argument_indices = dict(self.argument_indices)
+        return self.argument_indices
+
     def read_arguments(self, match):
+        groupdict = match.groupdict()
         self.ordered_arguments += match.groups()
-        self.keyword_arguments.update(match.groupdict())
-        ordered_group_names = [k for k in self.keyword_arguments.keys()]
-        ordered_group_names.sort(key=lambda x: match.span(x)[0])
-        for (i, k) in enumerate(ordered_group_names):
-            self.argument_indices[k] = i
+        self.keyword_arguments.update(groupdict)
+        self.argument_indices = self._argument_schema(match, groupdict)
 
     def translate_arguments(self, defs):
-        arg_update = {}
         for (k, v) in self.keyword_arguments.items():
             converted = defs.get(v, v)
-            arg_update[k] = converted
-            i = self.argument_indices[k]
-            self.ordered_arguments[i] = converted
-        self.keyword_arguments.update(arg_update)
+            self.keyword_arguments[k] = converted
+            self.ordered_arguments[self.argument_indices[k]] = converted
 
     def get_type(self):
         return self.note_type
@@ -29,26 +48,41 @@ class NoteToken:
         return self.keyword_arguments
 
     def add_modifiers(self, modifiers):
+        if self.modifiers is NO_MODIFIERS:
+            self.modifiers = {}
         self.modifiers.update(modifiers)
 
     def set_args(self, values):
         self.ordered_arguments = values
 
-    def set_arg(self, key, value, force=False): 
+    def set_arg(self, key, value, force=False):
         if force or key not in self.keyword_arguments or self.keyword_arguments[key] == None:
             self.keyword_arguments[key] = value
             if key in self.argument_indices:
                 self.ordered_arguments[self.argument_indices[key]] = value
             else:
-                self.argument_indices[key] = len(self.ordered_arguments)
+                self._own_indices()[key] = len(self.ordered_arguments)
                 self.ordered_arguments.append(value)
-        
+
     def set_order(self, keys):
         self.ordered_arguments = []
+        self.argument_indices = {}
         for (i, k) in enumerate(keys):
             self.argument_indices[k] = i
             self.ordered_arguments.append(self.keyword_arguments[k])
 
+    def copy(self):
+        '''A token that can be changed without changing this one, sharing what is copy-on-write'''
+        result = NoteToken.__new__(NoteToken)
+        result.note_type = self.note_type
+        result.ordered_arguments = list(self.ordered_arguments)
+        result.keyword_arguments = dict(self.keyword_arguments)
+        result.argument_indices = self.argument_indices
+        if not isinstance(self.argument_indices, MappingProxyType):
+            result.argument_indices = dict(self.argument_indices)
+        result.modifiers = self.modifiers if self.modifiers is NO_MODIFIERS else dict(self.modifiers)
+        return result
+
     def __eq__(self, other):
         if not isinstance(other, NoteToken):
             return False
@@ -58,8 +92,16 @@ class NoteToken:
             result = result and getattr(self, k) == getattr(other, k)
         return result
 
+    def __getstate__(self):
+        return (self.note_type, self.ordered_arguments, self.keyword_arguments, dict(self.argument_indices), dict(self.modifiers))
+
+    def __setstate__(self, state):
+        (self.note_type, self.ordered_arguments, self.keyword_arguments, indices, modifiers) = state
+        self.argument_indices = indices or NO_INDICES
+        self.modifiers = modifiers or NO_MODIFIERS
+
     def __str__(self):
-        return "%s(%s/%s, **%s)" % (self.note_type, self.ordered_arguments, self.keyword_arguments, self.modifiers)
+        return "%s(%s/%s, **%s)" % (self.note_type, self.ordered_arguments, self.keyword_arguments, dict(self.modifiers))
 
     def __repr__(self):
         return self.__str__()
@@ -69,8 +111,6 @@ class NoteToken:
 
         self.ordered_arguments = []
         self.keyword_arguments = {}
-        self.argument_indices = {}
-
-        self.note_called_arguments = self.ordered_arguments
+        self.argument_indices = NO_INDICES
 
-        self.modifiers = {}
+        self.modifiers = NO_MODIFIERS
@@ -0,0 +1,108 @@
+from threading import Thread
+from concurrent.futures import Future
+from queue import SimpleQueue, Empty
+from time import perf_counter
+from bpmusictransposer.metrics import metrics
+import os, signal, subprocess
+
+class RenderError(Exception):
+    pass
+
+class Renderer:
+    """Runs lilypond on queued .ly files with a fixed number of render slots
+
+    Each run is limited to timeout seconds per file and, when set, memory_limit bytes of
+    address space. When several files are waiting, a slot hands up to batch_size of them to
+    one lilypond run so they share its startup cost; files a batch did not produce a PDF for
+    are retried alone, so one bad tune only fails itself."""
+
+    def render(self, filename):
+        """Queue filename.ly, the returned Future completes once filename.pdf is written"""
+        future = Future()
+        self.render_queue.put((filename, future))
+        return future
+
+    def start(self):
+        for slot in self.slots:
+            slot.start()
+
+    def stop(self):
+        """Finish the renders already queued, then end the slots"""
+        for slot in self.slots:
+            self.render_queue.put(None)
+        for slot in self.slots:
+            slot.join()
+
+    def _next_batch(self):
+        request = self.render_queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        while len(batch) < self.batch_size:
+            try:
+                request = self.render_queue.get_nowait()
+            except Empty:
+                break
+            if request is None:
+                # Leave the stop request for after this batch
+                self.render_queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run_slot(self):
+        while (batch := self._next_batch()) is not None:
+            by_directory = {}
+            for (filename, future) in batch:
+                by_directory.setdefault(os.path.dirname(filename), []).append((filename, future))
+            for (directory, requests) in by_directory.items():
+                self._render_batch(directory, requests)
+
+    def _render_batch(self, directory, requests):
+        error = None
+        start = perf_counter()
+        try:
+            with metrics.stage("render"):
+                self._run(["%s.ly" % filename for (filename, future) in requests], directory, self.timeout * len(requests))
+        except (subprocess.SubprocessError, OSError) as e:
+            error = e
+        metrics.observe("render_run_seconds", perf_counter() - start)
+        for (filename, future) in requests:
+            if os.path.isfile("%s.pdf" % filename):
+                metrics.inc("renders_total", result="ok")
+                future.set_result(filename)
+            elif len(requests) > 1:
+                self._render_batch(directory, [(filename, future)])
+            else:
+                metrics.inc("renders_total", result="failed")
+                future.set_exception(RenderError("No PDF rendered for %s: %s" % (filename, error)))
+
+    def _command(self, files, directory):
+        command = [self.executable, "--output=%s" % (directory or "."), *files]
+        if self.memory_limit:
+            # preexec_fn isn't safe in a threaded process, have a shell set the limit before lilypond starts
+            command = ["/bin/sh", "-c", 'ulimit -v %d && exec "$@"' % (self.memory_limit // 1024), "lilypond", *command]
+        return command
+
+    def _run(self, files, directory, timeout):
+        process = subprocess.Popen(self._command(files, directory),
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        start_new_session=True)
+        try:
+            (output, _) = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # lilypond may have started ghostscript, end the whole session
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+            raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args, output)
+
+    def __init__(self, executable="/usr/bin/lilypond", slots=1, timeout=120, memory_limit=None, batch_size=1):
+        self.executable = executable
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.batch_size = max(batch_size, 1)
+        self.render_queue = SimpleQueue()
+        self.slots = [Thread(target=self._run_slot, daemon=True) for x in range(slots)]
@@ -1,22 +1,79 @@
-from flask import Flask, request, make_response, render_template, redirect, send_from_directory, url_for
+from flask import Flask, request, make_response, render_template, redirect, send_from_directory, url_for, Response
 from uuid import uuid4
-from bpmusictransposer.threadedworker import ThreadedWorker
+from threading import BoundedSemaphore
+from bpmusictransposer.threadedworker import WorkerPool
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.jobstore import open_job_store
+from bpmusictransposer.resultcache import ResultCache
+from bpmusictransposer.tunecache import open_tune_cache
+from bpmusictransposer.renderer import Renderer
+from bpmusictransposer.metrics import metrics
 import json
-import os, atexit
+import os, io, sys, atexit, zipfile
 
 def initialize(name):
     app = Flask(name)
     app.config['APPLICATION_ROOT'] = os.environ.get("FLASK_APPLICATION_ROOT", '/')
     app.config['UPLOAD_FOLDER'] = os.environ.get('FLASK_UPLOAD_FOLDER', '/tmp')
     app.config['JOB_LIST'] = os.environ.get('JOB_LIST', 'job.list')
+    app.config['JOB_STORE'] = os.environ.get('JOB_STORE', 'journal')
+    app.config['WORKER_COUNT'] = int(os.environ.get('WORKER_COUNT', 1))
+    app.config['WORKER_PROCESSES'] = os.environ.get('WORKER_PROCESSES', 'false').lower() in ['1', 'true', 'yes']
+    app.config['STATUS_WAIT'] = float(os.environ.get('STATUS_WAIT', 25))
+    # Each held status request ties up a server thread (waitress --threads, 64 in the Dockerfile) for up to
+    # STATUS_WAIT seconds. Past this many, status is answered at once with Retry-After instead of held, keep it
+    # well below the thread count so uploads and every other request still get a thread.
+    app.config['STATUS_WAITERS'] = int(os.environ.get('STATUS_WAITERS', 16))
+    app.config['STATUS_RETRY'] = int(os.environ.get('STATUS_RETRY', 2))
+    app.config['RESULT_CACHE'] = os.environ.get('RESULT_CACHE', os.path.join(app.config['UPLOAD_FOLDER'], 'cache'))
+    app.config['RESULT_CACHE_SIZE'] = int(os.environ.get('RESULT_CACHE_SIZE', 512 * 1024 * 1024))
+    # Directory to keep parsed uploads in, unset for none. It must belong to the service user alone:
+    # entries are unpickled, so one anyone else can write to is refused.
+    app.config['TUNE_CACHE'] = os.environ.get('TUNE_CACHE', '')
+    app.config['TUNE_CACHE_SIZE'] = int(os.environ.get('TUNE_CACHE_SIZE', 256 * 1024 * 1024))
+    app.config['LILYPOND'] = os.environ.get('LILYPOND', '/usr/bin/lilypond')
+    app.config['RENDER_SLOTS'] = int(os.environ.get('RENDER_SLOTS', 1))
+    app.config['RENDER_TIMEOUT'] = float(os.environ.get('RENDER_TIMEOUT', 120))
+    # Address space limit for each lilypond run in bytes, 0 for none
+    app.config['RENDER_MEMORY'] = int(os.environ.get('RENDER_MEMORY', 0))
+    app.config['RENDER_BATCH'] = int(os.environ.get('RENDER_BATCH', 8))
+    app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', 1000))
+    # Bytes of any one .bww and of all of a batch's .bww together, checked before a zip entry is inflated
+    app.config['BATCH_MAX_FILE_SIZE'] = int(os.environ.get('BATCH_MAX_FILE_SIZE', 1024 * 1024))
+    app.config['BATCH_MAX_TOTAL_SIZE'] = int(os.environ.get('BATCH_MAX_TOTAL_SIZE', 64 * 1024 * 1024))
+    app.config['METRICS'] = os.environ.get('METRICS', 'false').lower() in ['1', 'true', 'yes']
+    # Count the tokens each parser target wins, for /metrics. Slower parsing: the parsed token cache
+    # is off while counting. Only conversions in this process are counted, not with WORKER_PROCESSES.
+    app.config['MATCHER_STATS'] = os.environ.get('MATCHER_STATS', 'false').lower() in ['1', 'true', 'yes']
+    metrics.enable(app.config['METRICS'])
+    if app.config['METRICS'] and app.config['MATCHER_STATS']:
+        parser = MusicParser.parsers["BagpipeMusicWriter"]
+        parser.collect_matcher_stats()
+        metrics.gauge("matcher_hits_total", parser.matcher_hits, "Tokens matched, by parser target", "target", "counter")
+        metrics.gauge("matcher_unmatched_total", lambda: parser.matcher_stats["unmatched"], "Tokens no parser target matched", kind="counter")
+    app.status_waiters = BoundedSemaphore(app.config['STATUS_WAITERS'])
     with app.app_context():
         job_dir = app.config['UPLOAD_FOLDER']
         job_db = os.path.join(app.config['UPLOAD_FOLDER'], app.config['JOB_LIST'])
-        app.worker = ThreadedWorker()
-        app.worker.__configure__(job_dir, job_db)
+        job_store = open_job_store(job_db, app.config['JOB_STORE'])
+        result_cache = None
+        if app.config['RESULT_CACHE_SIZE'] > 0:
+            try:
+                result_cache = ResultCache(app.config['RESULT_CACHE'], app.config['RESULT_CACHE_SIZE'])
+            except PermissionError as e:
+                # Someone else's directory, serve without the cache rather than their files
+                print("Not using the result cache: %s" % e, file=sys.stderr)
+        tune_cache = None
+        if app.config['TUNE_CACHE'] and app.config['TUNE_CACHE_SIZE'] > 0:
+            try:
+                tune_cache = open_tune_cache(app.config['TUNE_CACHE'], app.config['TUNE_CACHE_SIZE'])
+            except PermissionError as e:
+                print("Not using the tune cache: %s" % e, file=sys.stderr)
+        renderer = Renderer(app.config['LILYPOND'], app.config['RENDER_SLOTS'], app.config['RENDER_TIMEOUT'],
+                app.config['RENDER_MEMORY'] or None, app.config['RENDER_BATCH'])
+        app.worker = WorkerPool(job_dir, job_store, app.config['WORKER_COUNT'], app.config['WORKER_PROCESSES'], result_cache, renderer, tune_cache)
         app.worker.start()
-    cleanup = app.worker.CleanupClass([app.worker])
-    atexit.register(cleanup.atexit)
+    atexit.register(app.worker.stop)
     return app
 
 app = initialize("bpmusictransposer.rest")
@@ -25,7 +82,11 @@ header = '<script src="https://code.jquery.com/jquery-3.7.1.min.js"></script>'
 
 @app.route("/")
 def docs():
-    return "%s<div><h1>Functions</h1><ul><li>parse</li><ul><li>GET uuid</li><li>CREATE { file: file }</li></ul></ul></div>" % header
+    return "%s<div><h1>Functions</h1><ul><li>parse</li><ul><li>GET uuid</li><li>CREATE { file: file }</li></ul><li>batch</li><ul><li>GET batch id</li><li>GET batch id/results</li><li>CREATE { to_parse: files or .zip }</li></ul></ul></div>" % header
+
+@app.get("/metrics")
+def get_metrics():
+    return make_response(metrics.prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4"})
 
 @app.get("/parse")
 def parse_request_page():
@@ -33,14 +94,17 @@ def parse_request_page():
 
 @app.post("/parse")
 def new_parse_request():
-    job_uuid = None
+    job_uuid = uuid4().hex
     try:
         f = request.files['to_parse']
-        job_uuid = uuid4().hex
-        save_result = f.save(os.path.join(app.config['UPLOAD_FOLDER'], job_uuid))
-        app.worker.queue_job(job_uuid, f.filename)
+        source = f.read()
     except Exception as e:
         return make_response(json.dumps({"result":"error"}), 500)
+    try:
+        # Parsing and generation happen here, only the PDF render is left queued
+        app.worker.queue_job(job_uuid, f.filename, source)
+    except Exception as e:
+        return make_response(json.dumps({"result":"error", "uuid": job_uuid, "error": str(e)}), 422)
     return redirect(url_for('parse_request_status', parse_uuid=job_uuid), 302)
 
 def get_parse_status(parse_uuid):
@@ -56,8 +120,15 @@ def parse_request_status(parse_uuid):
 
 @app.route("/parse/result/<string:parse_uuid>")
 def get_parse_result(parse_uuid):
-    if result := app.worker.get_job_status(parse_uuid):
-        return json.dumps(result)
+    # With ?since=<status>, hold the request until the status changes (or STATUS_WAIT passes)
+    busy = False
+    if known := request.args.get("since"):
+        (result, busy) = wait_or_answer(lambda: app.worker.wait_job_status(parse_uuid, known, app.config['STATUS_WAIT']),
+                lambda: app.worker.get_job_status(parse_uuid))
+    else:
+        result = app.worker.get_job_status(parse_uuid)
+    if result:
+        return retry_later(make_response(json.dumps(result)), busy)
     return make_response("Not Found", 404)
 
 @app.route("/parse/result/<string:parse_uuid>/file")
@@ -76,9 +147,150 @@ def get_parse_source(parse_uuid):
 def get_waitpage_js(parse_uuid):
     return render_template("waitpage.js.jinja", parse_uuid=parse_uuid)
 
+def wait_or_answer(wait, answer):
+    """(wait(), False) while fewer than STATUS_WAITERS requests are waiting, else (answer(), True) without holding the thread"""
+    if not app.status_waiters.acquire(blocking=False):
+        return (answer(), True)
+    try:
+        return (wait(), False)
+    finally:
+        app.status_waiters.release()
+
+def retry_later(response, busy):
+    if busy:
+        response.headers["Retry-After"] = str(app.config['STATUS_RETRY'])
+    return response
+
 def get_file(parse_uuid, extension):
     if job_state := app.worker.get_job_status(parse_uuid):
         response_opts = {"download_name": "%s.%s" % (job_state['name'], extension)}
         response = send_from_directory(app.config['UPLOAD_FOLDER'], "%s.%s" % (parse_uuid, extension), **response_opts)
         return response
     return None
+
+class BatchTooLarge(Exception):
+    pass
+
+def read_limited(stream, name, limit):
+    """At most limit bytes from stream, BatchTooLarge when there is more"""
+    data = stream.read(limit + 1)
+    if len(data) > limit:
+        raise BatchTooLarge("%s is larger than %d bytes" % (name, limit))
+    return data
+
+def batch_sources(files, max_file_size, max_total_size):
+    """(name, source) of each uploaded file, the .bww files inside an uploaded .zip taking its place
+
+    Raises BatchTooLarge for a file over max_file_size bytes or once they add up to over
+    max_total_size, zip entries are checked by their stated size before they are read."""
+    total = 0
+    def sized(name, size):
+        nonlocal total
+        total += size
+        if size > max_file_size:
+            raise BatchTooLarge("%s is larger than %d bytes" % (name, max_file_size))
+        if total > max_total_size:
+            raise BatchTooLarge("Files larger than %d bytes together" % max_total_size)
+    for f in files:
+        if not f.filename.lower().endswith(".zip"):
+            source = read_limited(f.stream, f.filename, max_file_size)
+            sized(f.filename, len(source))
+            yield (f.filename, source)
+            continue
+        with zipfile.ZipFile(f.stream) as archive:
+            for entry in archive.infolist():
+                if not entry.is_dir() and entry.filename.lower().endswith(".bww"):
+                    sized(entry.filename, entry.file_size)
+                    with archive.open(entry) as member:
+                        # The stated size could be a lie, never inflate past it
+                        yield (entry.filename, read_limited(member, entry.filename, entry.file_size))
+
+def result_name(name):
+    """Path in the results zip for an upload name, without its extension or any way out of the archive"""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ["", ".", ".."]]
+    return os.path.splitext("/".join(parts))[0] or "tune"
+
+class ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile, handing back what was written so far"""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+    def __init__(self):
+        self.chunks = []
+
+def iter_results_zip(statuses):
+    stream = ZipStream()
+    names = set()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for status in statuses:
+            name = result_name(status["name"])
+            if name in names:
+                name = "%s-%s" % (name, status["uuid"])
+            names.add(name)
+            status["result"] = name
+            if status["status"] == "Complete":
+                for extension in ["ly", "pdf"]:
+                    archive.write(os.path.join(app.config['UPLOAD_FOLDER'], "%s.%s" % (status["uuid"], extension)), "%s.%s" % (name, extension))
+                    yield stream.take()
+        archive.writestr("status.json", json.dumps(statuses, indent=2))
+    yield stream.take()
+
+def batch_response(batch, statuses, code=200):
+    return make_response(json.dumps({
+        "batch": batch,
+        "done": all(x["status"] in ["Complete", "Failed"] for x in statuses),
+        "jobs": statuses
+    }), code, {"Content-Type": "application/json"})
+
+@app.post("/batch")
+def new_batch_request():
+    files = request.files.getlist('to_parse')
+    try:
+        sources = list(batch_sources(files, app.config['BATCH_MAX_FILE_SIZE'], app.config['BATCH_MAX_TOTAL_SIZE']))
+    except zipfile.BadZipFile as e:
+        return make_response(json.dumps({"result": "error", "error": str(e)}), 400)
+    except BatchTooLarge as e:
+        return make_response(json.dumps({"result": "error", "error": str(e)}), 413)
+    if not sources:
+        return make_response(json.dumps({"result": "error", "error": "No .bww files uploaded"}), 400)
+    if len(sources) > app.config['BATCH_MAX_FILES']:
+        return make_response(json.dumps({"result": "error", "error": "More than %d files" % app.config['BATCH_MAX_FILES']}), 413)
+    batch = uuid4().hex
+    app.worker.queue_batch(batch, sources)
+    response = batch_response(batch, app.worker.get_batch_statuses(batch), 202)
+    response.headers["Location"] = url_for('batch_status', batch=batch)
+    return response
+
+@app.route("/batch/<string:batch>")
+def batch_status(batch):
+    # With ?wait, hold the request until every job is done (or STATUS_WAIT passes)
+    busy = False
+    if "wait" in request.args:
+        (statuses, busy) = wait_or_answer(lambda: app.worker.wait_batch(batch, app.config['STATUS_WAIT']),
+                lambda: app.worker.get_batch_statuses(batch))
+    else:
+        statuses = app.worker.get_batch_statuses(batch)
+    if statuses is None:
+        return make_response("Not Found", 404)
+    return retry_later(batch_response(batch, statuses), busy)
+
+@app.route("/batch/<string:batch>/results")
+def batch_results(batch):
+    statuses = app.worker.get_batch_statuses(batch)
+    if statuses is None:
+        return make_response("Not Found", 404)
+    if not all(x["status"] in ["Complete", "Failed"] for x in statuses):
+        return batch_response(batch, statuses, 409)
+    response = Response(iter_results_zip(statuses), mimetype="application/zip")
+    response.headers["Content-Disposition"] = "attachment; filename=%s.zip" % batch
+    return response
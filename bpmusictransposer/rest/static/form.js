@@ -2,6 +2,7 @@ $(document).ready(function(){
   var statusClasses = {
     "Queued": {"li": "bg-secondary", "a": "link-light"},
     "Processing": {"li": "bg-warning", "a": "link-dark"},
+    "Rendering": {"li": "bg-info", "a": "link-dark"},
     "Complete": {"li": "bg-success", "a": "link-light"},
     "Failed": {"li": "bg-danger", "a": "link-light"}
   }
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from threading import Lock
+from importlib import resources as impresources
+from bpmusictransposer import musicgenerator, tunecache
+from bpmusictransposer.musicparser import MusicParser
+import os, hashlib, shutil, tempfile
+
+result_extensions = ["ly", "pdf"]
+
+def link_results(source, target):
+    """Make the results of source (source.ly, source.pdf) available as target.ly and target.pdf"""
+    for extension in result_extensions:
+        source_file = "%s.%s" % (source, extension)
+        target_file = "%s.%s" % (target, extension)
+        try:
+            os.link(source_file, target_file)
+        except OSError:
+            shutil.copyfile(source_file, target_file)
+
+def results_version(parser):
+    """Hash of what results depend on besides the source: parser definitions, parsing and generating code, templates"""
+    digest = hashlib.sha256()
+    digest.update(parser.definitions_hash.encode())
+    digest.update(tunecache.code_version().encode())
+    with open(musicgenerator.__file__, 'rb') as file:
+        digest.update(file.read())
+    templates = impresources.files("bpmusictransposer") / "templates"
+    for template in sorted(templates.iterdir(), key=lambda x: x.name):
+        digest.update(template.name.encode())
+        digest.update(template.read_bytes())
+    return digest.hexdigest()
+
+class ResultCache:
+    """Conversion results kept by a hash of the uploaded source, least recently used evicted first
+
+    Keys also hash the parser definitions and the code and templates that make the results, so
+    nothing made before a grammar or generator change is served after it. Each entry is a
+    directory holding result.ly and result.pdf, renamed into place whole so a fetch never sees
+    only part of one. Results are served as they are found, so the directory must belong to
+    this user and not be writable by anyone else."""
+
+    def key(self, source):
+        return hashlib.sha256(self.version.encode() + b"\0" + source).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, filename):
+        """Link the cached results for key to filename.ly and filename.pdf, False when there are none"""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+        try:
+            link_results(os.path.join(self._entry(key), "result"), filename)
+            os.utime(self._entry(key))
+        except OSError:
+            # Evicted while linking, don't leave half of it behind
+            for extension in result_extensions:
+                try:
+                    os.unlink("%s.%s" % (filename, extension))
+                except FileNotFoundError:
+                    pass
+            return False
+        return True
+
+    def store(self, key, filename):
+        """Keep the results at filename.ly and filename.pdf for later uploads of the same source"""
+        with self.lock:
+            if key in self.entries:
+                return
+            # Hidden until renamed, _load clears any left by a crash
+            partial = tempfile.mkdtemp(prefix=".", dir=self.cache_dir)
+            link_results(filename, os.path.join(partial, "result"))
+            try:
+                os.rename(partial, self._entry(key))
+            except OSError:
+                # Already published by another process sharing the directory
+                shutil.rmtree(partial)
+            self.entries[key] = self._size(key)
+            self.size += self.entries[key]
+            self._evict()
+
+    def _size(self, key):
+        return sum(os.path.getsize(os.path.join(self._entry(key), "result.%s" % extension)) for extension in result_extensions)
+
+    def _remove(self, path):
+        # Renamed away first, so the entry disappears all at once
+        hidden = tempfile.mkdtemp(prefix=".", dir=self.cache_dir)
+        try:
+            os.rename(path, os.path.join(hidden, "entry"))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(hidden)
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            (key, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self._remove(self._entry(key))
+
+    def _load(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                # Unfinished entries, and results cached before keys were versioned
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.splitext(name)[1] in [".%s" % x for x in result_extensions]:
+                    os.unlink(path)
+                continue
+            try:
+                found.append((os.path.getmtime(path), name, self._size(name)))
+            except OSError:
+                shutil.rmtree(path, ignore_errors=True)
+        for (mtime, key, size) in sorted(found):
+            self.entries[key] = size
+            self.size += size
+        self._evict()
+
+    def __init__(self, cache_dir, max_size, version=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.version = version or results_version(MusicParser.parsers["BagpipeMusicWriter"])
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        tunecache.private_dir(cache_dir, "Result cache")
+        self._load()
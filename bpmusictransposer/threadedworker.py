@@ -1,104 +1,226 @@
-from threading import Thread, get_ident
-from bpmusictransposer.musicgenerator import MusicGenerator
+from threading import Lock, Condition, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from bpmusictransposer.musicgenerator import MusicGenerator, open_output
 from bpmusictransposer.musicparser import MusicParser
-from queue import SimpleQueue
+from bpmusictransposer.resultcache import link_results
+from bpmusictransposer.renderer import Renderer
+from bpmusictransposer.metrics import metrics
+from functools import partial
 from uuid import uuid4
-import os, json, time, sys, subprocess
+from time import perf_counter
+import os, io, sys, multiprocessing
 
-class ThreadedWorker(Thread):
+_generators = local()
+
+def convert_source(source, filename, collect=False, tune_cache=None):
+    """Parse uploaded BWW bytes and write the LilyPond source to filename.ly, in a pool thread or process
+
+    An upload holding several tunes gets a score for each in the one file. With collect, the
+    metrics recorded are returned for a parent process to merge. With tune_cache, a source
+    parsed before is not parsed again."""
+    if collect:
+        metrics.enable()
+    mp = MusicParser.parsers["BagpipeMusicWriter"]
+    if not hasattr(_generators, "mg"):
+        _generators.mg = MusicGenerator()
+    if tune_cache:
+        tunes = tune_cache.parse(source, mp, "tunes", lambda stream: list(mp.iter_tunes(stream)))
+    else:
+        with io.TextIOWrapper(io.BytesIO(source), encoding=mp.encoding) as stream:
+            tunes = list(mp.iter_tunes(stream))
+    with open_output("%s.ly" % filename) as file:
+        _generators.mg.write_book(tunes, file)
+    return metrics.take() if collect else None
+
+class WorkerPool:
+    """Converts uploads as they arrive and keeps the job list while the renderer makes their PDFs
+
+    Parsing and generation run in a pool of count threads, or processes when processes is set
+    so they can use every core. Only rendering is deferred, to the renderer's own queue and slots."""
     # TODO: Add reprocessing of failed job option
-    # TODO: Allow combining matching source files (And results) when they happen
-    work_queue = SimpleQueue()
-    is_running = True
-    parse_status = {}
-
-    def run(self):
-        """Continuously take tasks off the queue, convert them to .ly format, generate the pdf, then make them available"""
-        # TODO: Worker queue to clean them up afterwards
-        mp = MusicParser.parsers["BagpipeMusicWriter"]
-        mg = MusicGenerator()
-        while self.is_running:
-            try:
-                print("%d: Checking queue" % get_ident())
-                jobid = self.work_queue.get(timeout=15)
-                filename = os.path.join(self.job_dir, jobid)
-                print("%d: Processing %s" % (get_ident(), jobid))
-                # Wait 20s for the file to save:
-                for x in range(0, 20):
-                    print("%d: Waiting on file available" % get_ident())
-                    time.sleep(1.5)
-                    if os.path.isfile(filename):
-                        print("%d: File available" % get_ident())
-                        break
-                print("%d: Process %s" % (get_ident(), jobid))
-                try:
-                    self.set_job_status(jobid, { "status": "Processing" })
-                    with open(filename) as file:
-                        tunestr = file.read()
-                    os.unlink(filename)
-                    tune = mp.get_tune(tunestr)
-                    resultstr = mg.from_tune(tune)
-                    with open("%s.ly" % filename, 'x') as file:
-                        file.write(resultstr)
-                    print("%d: Completed internal processing of %s" % (get_ident(), filename))
-                    result = subprocess.run(["/usr/bin/lilypond", "-o", filename, "%s.ly" % filename]).check_returncode()
-                    print("%d: Completed processing of %s" % (get_ident(), jobid))
-                    self.set_job_status(jobid, { "status": "Complete" })
-                    self.write_jobdb()
-                except Exception as e:
-                    print("%d: Worker Exception" % get_ident())
-                    print(e, file=sys.stderr)
-                    self.set_job_status(jobid, {"status": "Failed" })
-                    self.write_jobdb()
-                    if os.path.isfile(filename):
-                        print("%d: Leaving %s" % (get_ident(), filename))
-                        #os.unlink(filename)
-            except Exception as e:
-                # Do nothing
-                pass
-
-    def write_jobdb(self):
-        # TODO: Be more efficient than this
-        with open(self.job_db, 'w') as dbfile:
-            dbfile.truncate(0)
-            dbfile.write(json.dumps(self.parse_status))
-    
+
+    def start(self):
+        self.renderer.start()
+
+    def stop(self):
+        self.executor.shutdown()
+        self.renderer.stop()
+        self.store.close()
+        for (jobid, state) in self.parse_status.items():
+            if state["status"] in ["Queued", "Processing", "Rendering"]:
+                print("Cancel job: %s, %s" % (jobid, state))
+
+    def convert(self, source, filename):
+        collected = self.executor.submit(convert_source, source, filename, self.processes and metrics.enabled, self.tune_cache).result()
+        if collected:
+            metrics.merge(collected)
+
+    def finish_render(self, uuid, key, render):
+        if error := render.exception():
+            print("Render of %s failed" % uuid)
+            print(error, file=sys.stderr)
+            self.finish_job(uuid, key, "Failed")
+        else:
+            print("Completed processing of %s" % uuid)
+            self.finish_job(uuid, key, "Complete")
+
+    def finish_job(self, uuid, key, status):
+        """Set the final status of a job, and of any duplicate uploads that waited on it"""
+        filename = os.path.join(self.job_dir, uuid)
+        if status == "Complete" and self.cache:
+            self.cache.store(key, filename)
+        with self.lock:
+            self._update_status(uuid, { "status": status })
+            for duplicate in self.in_flight.pop(key, []):
+                duplicate_status = status
+                if status == "Complete":
+                    try:
+                        link_results(filename, os.path.join(self.job_dir, duplicate))
+                    except OSError:
+                        duplicate_status = "Failed"
+                self._update_status(duplicate, { "status": duplicate_status })
+
     def set_job_status(self, uuid, update):
+        with self.lock:
+            self._update_status(uuid, update)
+
+    def _update_status(self, uuid, update):
         self.parse_status[uuid].update(update)
+        self.store.update(uuid, self.parse_status[uuid])
+        self.status_changed.notify_all()
+        if update.get("status") in ["Complete", "Failed"] and uuid in self.started:
+            metrics.observe("job_seconds", perf_counter() - self.started.pop(uuid))
+            metrics.inc("jobs_total", status=update["status"])
+
+    def _status_counts(self):
+        with self.lock:
+            counts = {}
+            for state in self.parse_status.values():
+                counts[state["status"]] = counts.get(state["status"], 0) + 1
+            return counts
 
     def get_job_status(self, uuid):
         if uuid in self.parse_status:
             return self.parse_status[uuid]
         return None
 
+    def wait_job_status(self, uuid, known, timeout):
+        """Wait up to timeout seconds for a job to leave the known status, then return its status"""
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: self.parse_status.get(uuid, {}).get("status") != known, timeout)
+            return self.get_job_status(uuid)
+
     def get_job_statuses(self):
-        return [x for x in self.parse_status.values()]
-
-    def queue_job(self, uuid, filename):
-        self.parse_status[uuid] = { "status": "Queued", "name": filename, "uuid": uuid }
-        print("Add %s to worker")
-        self.work_queue.put(uuid, timeout=5)
-        print("Added")
-
-    class CleanupClass:
-        def atexit(self):
-            for worker in self.workers:
-                worker.is_running = False
-                worker.join()
-            for (jobid, state) in [item for item in worker.parse_status.items() for worker in self.workers]:
-                print("Cancel job: %s, %s" % (jobid, state))
+        with self.lock:
+            return [x for x in self.parse_status.values()]
+
+    def get_batch_statuses(self, batch):
+        with self.lock:
+            if batch not in self.batches:
+                return None
+            return [dict(self.parse_status[uuid]) for uuid in self.batches[batch]]
+
+    def wait_batch(self, batch, timeout):
+        """Wait up to timeout seconds for every job of a batch to complete or fail, then return their statuses"""
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: all(self.parse_status[uuid]["status"] in ["Complete", "Failed"] for uuid in self.batches.get(batch, [])), timeout)
+        return self.get_batch_statuses(batch)
+
+    def queue_batch(self, batch, files):
+        """Queue each (filename, source) of files as a job of the batch and return the job ids
 
-        def __init__(self, workers):
-            self.workers = workers
+        Conversions are only submitted here, so this returns before any of them finish. Unlike
+        queue_job a file that fails to convert is only marked Failed, the rest still go ahead."""
+        jobs = []
+        for (filename, source) in files:
+            uuid = uuid4().hex
+            jobs.append(uuid)
+            if (key := self._add_job(uuid, filename, source, batch)) is None:
+                continue
+            conversion = self.executor.submit(convert_source, source, os.path.join(self.job_dir, uuid), self.processes and metrics.enabled, self.tune_cache)
+            conversion.add_done_callback(partial(self.finish_conversion, uuid, key))
+        return jobs
 
-    def load_requests(self, job_db):
-        job_list = job_db
-        if not os.path.exists(job_list):
+    def queue_job(self, uuid, filename, source, batch=None):
+        """Convert the uploaded file contents to its .ly now and queue the PDF render
+
+        Sources converted before complete straight from the cache, and a source that is
+        already converting or rendering waits on that job instead of converting again.
+        A conversion error marks the job Failed and is raised to the caller."""
+        if (key := self._add_job(uuid, filename, source, batch)) is None:
+            return
+        try:
+            self.convert(source, os.path.join(self.job_dir, uuid))
+        except Exception as e:
+            self.finish_convert(uuid, key, e)
+            raise
+        self.finish_convert(uuid, key)
+
+    def finish_conversion(self, uuid, key, conversion):
+        """Done callback of a conversion submitted by queue_batch"""
+        if (error := conversion.exception()) is None and (collected := conversion.result()):
+            metrics.merge(collected)
+        self.finish_convert(uuid, key, error)
+
+    def finish_convert(self, uuid, key, error=None):
+        """Mark the job Failed when its conversion raised error, otherwise queue its PDF render"""
+        if error:
+            print("Conversion of %s failed, %s" % (uuid, error), file=sys.stderr)
+            self.finish_job(uuid, key, "Failed")
             return
-        with open(job_db, 'r') as dbfile:
-            self.parse_status.update(json.loads(dbfile.read()))
+        print("Render %s" % uuid)
+        self.set_job_status(uuid, { "status": "Rendering" })
+        self.renderer.render(os.path.join(self.job_dir, uuid)).add_done_callback(partial(self.finish_render, uuid, key))
+
+    def _add_job(self, uuid, filename, source, batch=None):
+        """Add a job to the job list, returning its source key when it still has to be converted"""
+        key = self.cache.key(source) if self.cache else uuid
+        with self.lock:
+            self.started[uuid] = perf_counter()
+            self.parse_status[uuid] = { "status": "Queued", "name": filename, "uuid": uuid }
+            if batch:
+                self.parse_status[uuid]["batch"] = batch
+                self.batches.setdefault(batch, []).append(uuid)
+            self.store.update(uuid, self.parse_status[uuid])
+            if key in self.in_flight:
+                print("Add %s to in progress %s" % (uuid, key))
+                self.in_flight[key].append(uuid)
+                return None
+            if self.cache and self.cache.fetch(key, os.path.join(self.job_dir, uuid)):
+                print("Complete %s from cache" % uuid)
+                self._update_status(uuid, { "status": "Complete" })
+                return None
+            self.in_flight[key] = []
+            self._update_status(uuid, { "status": "Processing" })
+        return key
+
+    def load_requests(self, store):
+        self.parse_status.update(store.load())
+        for (uuid, state) in self.parse_status.items():
+            if "batch" in state:
+                self.batches.setdefault(state["batch"], []).append(uuid)
 
-    def __configure__(self, job_dir, dbfile):
+    def __init__(self, job_dir, store, count=1, processes=False, cache=None, renderer=None, tune_cache=None):
         self.job_dir = job_dir
-        self.job_db = dbfile
-        self.load_requests(dbfile)
+        self.store = store
+        self.cache = cache
+        self.tune_cache = tune_cache
+        self.renderer = renderer or Renderer()
+        # Source key -> duplicate job ids waiting on the job converting it
+        self.in_flight = {}
+        self.parse_status = {}
+        # Job id -> when it was uploaded, until it completes or fails
+        self.started = {}
+        # Batch id -> job ids, in upload order
+        self.batches = {}
+        self.lock = Lock()
+        self.status_changed = Condition(self.lock)
+        self.processes = processes
+        if processes:
+            # Forking a server that already runs threads can copy a lock another thread holds into the child
+            self.executor = ProcessPoolExecutor(max_workers=count, mp_context=multiprocessing.get_context("forkserver"))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=count)
+        metrics.gauge("render_queue_depth", self.renderer.render_queue.qsize, "Files waiting for a render slot")
+        metrics.gauge("jobs", self._status_counts, "Jobs in the job list by status")
+        self.load_requests(store)
@@ -1,28 +1,146 @@
-import os, sys
+import os, re, sys, time
 from argparse import ArgumentParser
-from bpmusictransposer.musicgenerator import MusicGenerator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bpmusictransposer.musicgenerator import MusicGenerator, open_output
 from bpmusictransposer.musicparser import MusicParser
 from bpmusictransposer.logger import Logger
+from bpmusictransposer.metrics import metrics
+from bpmusictransposer.tunecache import open_tune_cache
 
 def generate(tune, output, logger):
     # TODO: Allow selection of a generated type
     logger.log("Generate file %s" % output, 1)
     generator = MusicGenerator()
     generator.logger = logger
-    tunestr = generator.from_tune(tune)
-    with open(output, 'x') as file:
-        file.write(tunestr)
-    return tunestr
+    with open_output(output) as file:
+        generator.write_tune(tune, file)
 
-def parse(filename, logger):
+def parse(filename, logger, tune_cache=None):
     # TODO: Detect filetype and select the parser type
     parser = MusicParser.parsers['BagpipeMusicWriter']
     parser.logger = logger
     logger.log("Parse file %s" % filename, 1)
+    if tune_cache:
+        return cached_parse(filename, parser, tune_cache, "tune", parser.get_tune_from_stream)
     with open(filename, 'r', encoding="cp1252") as file:
-        tune = parser.get_tune(file.read())
+        tune = parser.get_tune_from_stream(file)
     return tune
 
+def parse_tunes(filename, logger, tune_cache=None):
+    '''Every tune in a file, tune books hold more than one'''
+    parser = MusicParser.parsers['BagpipeMusicWriter']
+    parser.logger = logger
+    logger.log("Parse file %s" % filename, 1)
+    if tune_cache:
+        return cached_parse(filename, parser, tune_cache, "tunes", lambda stream: list(parser.iter_tunes(stream)))
+    with open(filename, 'r', encoding="cp1252") as file:
+        return list(parser.iter_tunes(file))
+
+def cached_parse(filename, parser, tune_cache, kind, function):
+    with open(filename, 'rb') as file:
+        source = file.read()
+    return tune_cache.parse(source, parser, kind, function)
+
+def book_suffix(filename, index, count):
+    name = re.sub(r'[^\w-]', '_', os.path.splitext(os.path.basename(filename))[0])
+    return name if count == 1 else "%s-%d" % (name, index + 1)
+
+def parse_book_file(filename, loglevel, tune_cache=None, collect=False):
+    '''parse_tunes in a worker process, with the metrics it recorded for the parent to merge when collect is set'''
+    logger = Logger()
+    logger.set_loglevel(loglevel)
+    metrics.enable(collect)
+    tunes = parse_tunes(filename, logger, tune_cache)
+    return (tunes, metrics.take() if collect else None)
+
+def parse_book_files(filenames, logger, jobs=1, tune_cache=None):
+    '''Yield (filename, tunes, exception) for every file in the order given, tunes is None when it failed'''
+    if jobs <= 1:
+        for filename in filenames:
+            try:
+                yield (filename, parse_tunes(filename, logger, tune_cache), None)
+            except Exception as e:
+                yield (filename, None, e)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(parse_book_file, filename, logger.logLevel, tune_cache, metrics.enabled) for filename in filenames]
+        for (filename, future) in zip(filenames, futures):
+            try:
+                (tunes, taken) = future.result()
+                if taken:
+                    metrics.merge(taken)
+                yield (filename, tunes, None)
+            except Exception as e:
+                yield (filename, None, e)
+
+def convert_book(filenames, output, loglevel, split=False, tune_cache=None, jobs=1):
+    '''Yield (filename, exception) for every file as it is parsed, then write all their tunes to one .ly
+
+    With split, lilypond writes a separate output-<file>.pdf for each tune from that one file. Files
+    are parsed jobs at a time in separate processes, the book keeps them in the order given. Problems
+    with the book itself are yielded as (output, exception), an existing output before any parsing.'''
+    logger = Logger()
+    logger.set_loglevel(loglevel)
+    if os.path.exists(output):
+        yield (output, FileExistsError("File exists: '%s'" % output))
+        return
+    tunes = []
+    suffixes = []
+    for (filename, file_tunes, error) in parse_book_files(filenames, logger, jobs, tune_cache):
+        if error:
+            yield (filename, error)
+            continue
+        for (i, tune) in enumerate(file_tunes):
+            tunes.append(tune)
+            suffixes.append(book_suffix(filename, i, len(file_tunes)))
+        yield (filename, None)
+    if not tunes:
+        logger.log("No tunes to write to book %s" % output, 1)
+        return
+    logger.log("Generate book %s" % output, 1)
+    generator = MusicGenerator()
+    generator.logger = logger
+    try:
+        with open_output(output) as file:
+            generator.write_book(tunes, file, suffixes if split else None)
+    except Exception as e:
+        yield (output, e)
+
+def convert(filename, loglevel, tune_cache=None):
+    # Build the logger here, an open stream can't be sent to a worker process
+    logger = Logger()
+    logger.set_loglevel(loglevel)
+    generate(parse(filename, logger, tune_cache), "%s.ly" % filename, logger)
+    return filename
+
+def convert_collected(filename, loglevel, tune_cache=None):
+    '''convert in a worker process, returning the metrics it recorded for the parent to merge'''
+    metrics.enable()
+    convert(filename, loglevel, tune_cache)
+    return metrics.take()
+
+def convert_all(filenames, loglevel, jobs=1, ordered=False, tune_cache=None):
+    '''Yield (filename, exception) for every file, exception is None when it converted'''
+    if jobs <= 1:
+        for filename in filenames:
+            try:
+                convert(filename, loglevel, tune_cache)
+                yield (filename, None)
+            except Exception as e:
+                yield (filename, e)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        task = convert_collected if metrics.enabled else convert
+        futures = {pool.submit(task, filename, loglevel, tune_cache): filename for filename in filenames}
+        for future in (futures if ordered else as_completed(futures)):
+            try:
+                result = future.result()
+                if metrics.enabled:
+                    metrics.merge(result)
+                yield (futures[future], None)
+            except Exception as e:
+                yield (futures[future], e)
+
 def parseargs():
     parser = ArgumentParser(
                     prog='Music Transposer',
@@ -30,6 +148,29 @@ def parseargs():
                 )
     parser.add_argument('-v', '--verbose',
                     action='count')
+    parser.add_argument('-j', '--jobs',
+                    type=int,
+                    default=1,
+                    help="Convert this many files at once in separate processes, with --book parse them")
+    parser.add_argument('--ordered',
+                    action='store_true',
+                    help="Report results in the order the files were given instead of as they finish")
+    parser.add_argument('--book',
+                    metavar='OUTPUT',
+                    help="Write every tune into the single LilyPond file OUTPUT, to render in one lilypond run")
+    parser.add_argument('--split',
+                    action='store_true',
+                    help="With --book, have lilypond write a separate PDF for each tune")
+    parser.add_argument('--profile',
+                    action='store_true',
+                    help="Print the time spent in each stage of the conversion")
+    parser.add_argument('--tune-cache',
+                    metavar='DIR',
+                    help="Keep parsed tunes in DIR, so files that did not change are not parsed again. DIR must be yours alone, it is made private when new")
+    parser.add_argument('--tune-cache-size',
+                    type=int,
+                    default=256 * 1024 * 1024,
+                    help="Bytes of parsed tunes to keep in the --tune-cache DIR, 0 to not use it")
     parser.add_argument('filenames',
                     nargs='+')
     return parser.parse_args()
@@ -38,5 +179,29 @@ def main():
     arguments = parseargs()
     logger = Logger()
     logger.set_loglevel(int(arguments.verbose or 1))
-    [generate(parse(filename, logger), "%s.ly" % filename, logger) for filename in arguments.filenames]
-    return 0
+    metrics.enable(arguments.profile)
+    start = time.perf_counter()
+    failed = []
+    converted = 0
+    tune_cache = None
+    if arguments.tune_cache and arguments.tune_cache_size > 0:
+        try:
+            tune_cache = open_tune_cache(arguments.tune_cache, arguments.tune_cache_size)
+        except OSError as e:
+            print("Not using the tune cache: %s" % e, file=sys.stderr)
+    if arguments.book:
+        results = convert_book(arguments.filenames, arguments.book, logger.logLevel, arguments.split, tune_cache, arguments.jobs)
+    else:
+        results = convert_all(arguments.filenames, logger.logLevel, arguments.jobs, arguments.ordered, tune_cache)
+    for (filename, error) in results:
+        if error:
+            failed.append(filename)
+            print("Failed %s: %s" % (filename, error), file=sys.stderr)
+        else:
+            converted += 1
+            logger.log("Converted %s" % filename, 1)
+    elapsed = time.perf_counter() - start
+    logger.log("Converted %d of %d files in %.2fs (%.1f files/s)" % (converted, len(arguments.filenames), elapsed, len(arguments.filenames) / elapsed), 1)
+    if arguments.profile:
+        print(metrics.summary(), file=sys.stderr)
+    return 1 if failed else 0
@@ -0,0 +1,151 @@
+from threading import Lock
+from contextlib import contextmanager
+from bpmusictransposer import musicparser, notetoken, tune
+from bpmusictransposer.metrics import metrics
+import os, io, stat, time, fcntl, pickle, hashlib
+
+suffix = ".pickle"
+# Held while storing or evicting, and holds the size of the entries in the directory
+lock_name = ".lock"
+_opened = {}
+_opened_lock = Lock()
+
+def code_version():
+    """Hash of the modules a parsed Tune is built and pickled by"""
+    digest = hashlib.sha256()
+    for module in [musicparser, notetoken, tune]:
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def private_dir(path, what):
+    """Make path a directory only this user can write to, PermissionError when it already is one others can"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError("%s %s must belong to this user and not be writable by others" % (what, path))
+
+def open_tune_cache(cache_dir, max_size):
+    """The TuneCache for cache_dir, one per process however often it is opened or sent to a worker"""
+    with _opened_lock:
+        if (cache_dir, max_size) not in _opened:
+            _opened[(cache_dir, max_size)] = TuneCache(cache_dir, max_size)
+        return _opened[(cache_dir, max_size)]
+
+class TuneCache:
+    """Parsed Tunes pickled on disk by a hash of their source, the parser definitions and the parsing code
+
+    Changing any of those gives new keys, the entries left behind are evicted in time as the
+    least recently used. Unpickling runs code, so the directory must belong to this user and
+    not be writable by anyone else. Several processes can share it: the total size is kept in
+    its lock file, and whoever takes it over max_size evicts by modification time."""
+
+    def key(self, source, parser, kind="tunes"):
+        digest = hashlib.sha256()
+        for part in [self.code_version, parser.definitions_hash, kind]:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        digest.update(source)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def fetch(self, key):
+        """What was stored for key, None when there is nothing"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            self._touch(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def store(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        path = self._path(key)
+        with self._locked() as lock:
+            if os.path.exists(path):
+                return
+            # Renamed into place so no reader sees part of it
+            partial = "%s.%d.tmp" % (path, os.getpid())
+            with open(partial, 'wb') as file:
+                file.write(data)
+            self._touch(partial)
+            os.replace(partial, path)
+            self._account(lock, len(data))
+
+    def parse(self, source, parser, kind, function):
+        """function(stream) over the source bytes decoded for parser, or what it returned last time for them"""
+        key = self.key(source, parser, kind)
+        value = self.fetch(key)
+        metrics.inc("tune_cache_total", result="miss" if value is None else "hit")
+        if value is None:
+            with io.TextIOWrapper(io.BytesIO(source), encoding=parser.encoding) as stream:
+                value = function(stream)
+            self.store(key, value)
+        return value
+
+    def _touch(self, path):
+        # The modification time orders entries for eviction. Set from the clock, the time the
+        # filesystem would give can be a coarse tick shared by everything just before.
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    @contextmanager
+    def _locked(self):
+        # flock locks conflict between separate opens, so this serializes threads as well as processes
+        lock = os.open(os.path.join(self.cache_dir, lock_name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield lock
+        finally:
+            os.close(lock)
+
+    def _account(self, lock, added):
+        try:
+            size = int(os.pread(lock, 32, 0)) + added
+        except ValueError:
+            # A new lock file, the directory has to be scanned to know
+            size = None
+        if size is None or size > self.max_size:
+            size = self._evict()
+        os.ftruncate(lock, 0)
+        os.pwrite(lock, b"%d" % size, 0)
+
+    def _evict(self):
+        """Remove the least recently used entries until the directory is within max_size, returning its size"""
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name.endswith(".tmp"):
+                    # Stores hold the lock, this is left from one that died
+                    os.unlink(path)
+                elif name.endswith(suffix):
+                    info = os.stat(path)
+                    found.append((info.st_mtime_ns, name, info.st_size))
+            except FileNotFoundError:
+                pass
+        found.sort()
+        size = sum(x[2] for x in found)
+        for (mtime, name, entry_size) in found:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        return size
+
+    def __reduce__(self):
+        # Worker processes get their own shared instance rather than a copy
+        return (open_tune_cache, (self.cache_dir, self.max_size))
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.code_version = code_version()
+        private_dir(cache_dir, "Tune cache")
@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+from bpmusictransposer.bench import synthetic_corpus, run_benchmark
+from bpmusictransposer.musicparser import MusicParser
+
+class TestBench(unittest.TestCase):
+    def test_corpus_is_repeatable(self):
+        self.assertEqual(synthetic_corpus(2, 8, 0.5, 1), synthetic_corpus(2, 8, 0.5, 1))
+        self.assertNotEqual(synthetic_corpus(2, 8, 0.5, 1), synthetic_corpus(2, 8, 0.5, 2))
+
+    def test_corpus_parses(self):
+        parser = MusicParser.parsers["BagpipeMusicWriter"]
+        for text in synthetic_corpus(3, 8, 0.5):
+            music = [word for line in text.split("\n")[5:] for word in line.split()]
+            # Every word is a token of its own except dots, which land on their note
+            expected = [word for word in music if not word.startswith("'") or word == "''!I"]
+            tokens = parser.parse(text)
+            self.assertEqual(["title", "tunetype", "composer", "tempo"], [x.get_type() for x in tokens[:4]])
+            self.assertEqual(len(expected), len(tokens) - 4)
+
+    def test_report(self):
+        results = run_benchmark(synthetic_corpus(2, 4), repeat=1)
+        self.assertEqual(["parse", "parse_cached", "generate", "memory", "import"], list(results.keys()))
+        self.assertGreater(results["parse"]["tokens_per_second"], 0)
+        self.assertEqual(results["parse"]["tokens"], results["parse_cached"]["tokens"])
+        self.assertGreater(results["generate"]["notes"], 0)
+
+    def test_parse_timed_cold(self):
+        parser = MusicParser.parsers["BagpipeMusicWriter"]
+        corpus = synthetic_corpus(2, 4)
+        parser.parse(corpus[0])
+        sizes = []
+        original = parser.parse
+        def parse(text):
+            sizes.append(len(parser.token_cache))
+            return original(text)
+        with mock.patch.object(parser, "parse", parse):
+            run_benchmark(corpus, repeat=2)
+        # The first parse of each cold run starts from an empty token cache
+        self.assertEqual([0, 0], sizes[0:4:2])
+
+if __name__ == "__main__":
+    unittest.main()
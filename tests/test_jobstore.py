@@ -0,0 +1,77 @@
+import unittest, os, json, shutil, tempfile
+from bpmusictransposer.jobstore import JournalJobStore, SqliteJobStore
+
+class TestJournalJobStore(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.maxDiff = None
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "job.list")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _lines(self):
+        with open(self.path) as journal:
+            return journal.readlines()
+
+    def test_last_update_wins(self):
+        store = JournalJobStore(self.path)
+        store.load()
+        store.update("a", {"uuid": "a", "status": "Queued"})
+        store.update("b", {"uuid": "b", "status": "Queued"})
+        store.update("a", {"uuid": "a", "status": "Complete"})
+        store.close()
+        self.assertEqual(3, len(self._lines()))
+        expected = {"a": {"uuid": "a", "status": "Complete"}, "b": {"uuid": "b", "status": "Queued"}}
+        self.assertEqual(expected, JournalJobStore(self.path).load())
+
+    def test_load_compacts(self):
+        store = JournalJobStore(self.path)
+        store.load()
+        for status in ["Queued", "Processing", "Complete"]:
+            store.update("a", {"uuid": "a", "status": status})
+        store.close()
+        JournalJobStore(self.path).load()
+        self.assertEqual(1, len(self._lines()))
+
+    def test_compacts_while_running(self):
+        store = JournalJobStore(self.path)
+        store.compact_min = 10
+        store.load()
+        for i in range(50):
+            store.update("a", {"uuid": "a", "status": str(i)})
+        store.close()
+        self.assertLessEqual(len(self._lines()), 10)
+        self.assertEqual({"a": {"uuid": "a", "status": "49"}}, JournalJobStore(self.path).load())
+
+    def test_legacy_job_list(self):
+        legacy = {"a": {"uuid": "a", "status": "Complete", "name": "tune.bww"}}
+        with open(self.path, 'w') as dbfile:
+            dbfile.write(json.dumps(legacy))
+        self.assertEqual(legacy, JournalJobStore(self.path).load())
+        self.assertEqual([json.dumps(legacy["a"]) + "\n"], self._lines())
+
+    def test_interrupted_write(self):
+        with open(self.path, 'w') as journal:
+            journal.write('{"uuid": "a", "status": "Queued"}\n{"uuid": "a", "sta')
+        self.assertEqual({"a": {"uuid": "a", "status": "Queued"}}, JournalJobStore(self.path).load())
+
+class TestSqliteJobStore(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "jobs.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_last_update_wins(self):
+        store = SqliteJobStore(self.path)
+        store.update("a", {"uuid": "a", "status": "Queued"})
+        store.update("a", {"uuid": "a", "status": "Complete"})
+        store.close()
+        self.assertEqual({"a": {"uuid": "a", "status": "Complete"}}, SqliteJobStore(self.path).load())
+
+if __name__ == "__main__":
+    unittest.main()
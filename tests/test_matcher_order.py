@@ -0,0 +1,75 @@
+import unittest, os, json, tempfile
+from unittest import mock
+from importlib import resources as impresources
+from bpmusictransposer import parserdefs, matcherorder
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.matcherorder import Nfa, overlap, order_by_hits
+
+def new_parser():
+    return MusicParser(json.loads((impresources.files(parserdefs) / "BWW.v1.0.json").read_text()), register=False)
+
+class TestMatcherOrder(unittest.TestCase):
+    def _overlap(self, a, b):
+        return overlap(Nfa(a), Nfa(b))
+
+    def test_overlap(self):
+        self.assertTrue(self._overlap("a+", "a{2}"))
+        self.assertTrue(self._overlap("(?P<x>'+)(?:a|b)", "'\\w+"))
+        self.assertTrue(self._overlap("[^x]y", "zy"))
+        self.assertFalse(self._overlap("\\d+", "[a-z]+"))
+        self.assertFalse(self._overlap("ab?", "abc"))
+        self.assertFalse(self._overlap("(?:echo|str?)b", "[a-g]st[a-g]"))
+
+    def test_order_keeps_precedence(self):
+        # "ab" is hit most but "a." must still be tried before it
+        self.assertEqual([2, 0, 1], order_by_hits(["a.", "ab", "x"], [0, 5, 10]))
+        self.assertEqual([1, 2, 0], order_by_hits(["a", "b", "c"], [1, 5, 3]))
+
+    def test_order_kept_without_regex_parser(self):
+        with mock.patch.object(matcherorder, "sre_parse", None):
+            self.assertEqual([0, 1, 2], order_by_hits(["a", "b", "c"], [1, 5, 3]))
+
+    def test_learned_order_parses_the_same(self):
+        with open("omnitest/omnitest.bww", encoding="cp1252") as file:
+            music = file.read()
+        parser = new_parser()
+        expected = [str(x) for x in parser.parse(music)]
+        parser.collect_matcher_stats()
+        parser.parse(music)
+        hits = sum(row["hits"] for row in parser.matcher_report())
+        parser.learn_matcher_order()
+        self.assertNotEqual(parser.definition_matchers, parser.parser_matchers)
+        # The counts follow their matchers to their new positions
+        report = parser.matcher_report()
+        self.assertEqual(hits, sum(row["hits"] for row in report))
+        self.assertEqual("note", report[0]["target"])
+        self.assertEqual(expected, [str(x) for x in parser.parse(music)])
+
+    def test_matcher_hits(self):
+        parser = new_parser()
+        parser.collect_matcher_stats()
+        parser.parse("LA_4 B_8 ! junk")
+        hits = parser.matcher_hits()
+        self.assertEqual(2, hits["note"])
+        self.assertEqual(1, hits["barend"])
+        self.assertEqual(3, sum(hits.values()))
+        self.assertEqual(1, parser.matcher_stats["unmatched"])
+
+    def test_save_and_load(self):
+        parser = new_parser()
+        parser.collect_matcher_stats()
+        parser.parse("LA_4 ! ! ! gg")
+        parser.learn_matcher_order()
+        with tempfile.TemporaryDirectory() as workdir:
+            path = parser.save_matcher_order(os.path.join(workdir, "order.json"))
+            loaded = new_parser()
+            self.assertTrue(loaded.load_matcher_order(path))
+            self.assertEqual([t for (t, m) in parser.parser_matchers], [t for (t, m) in loaded.parser_matchers])
+
+            # An order learned for other definitions is not used
+            other = new_parser()
+            other.definition_matchers = other.definition_matchers[1:]
+            self.assertFalse(other.load_matcher_order(path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest, io, time
+from bpmusictransposer.metrics import Metrics
+from bpmusictransposer.notetoken import NoteToken
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.enable()
+
+    def _stage(self, name):
+        return self.metrics.counters.get(("stage_seconds_total", (("stage", name),)), 0)
+
+    def test_disabled_records_nothing(self):
+        metrics = Metrics()
+        metrics.inc("x")
+        with metrics.stage("a"):
+            pass
+        self.assertEqual([1, 2], list(metrics.timed("b", [1, 2])))
+        self.assertEqual({}, metrics.counters)
+
+    def test_nested_stages_are_exclusive(self):
+        def slow(items):
+            for item in items:
+                time.sleep(0.01)
+                yield item
+        with self.metrics.stage("outer"):
+            self.assertEqual([1, 2, 3], list(self.metrics.timed("inner", slow([1, 2, 3]))))
+        self.assertGreaterEqual(self._stage("inner"), 0.03)
+        self.assertLess(self._stage("outer"), 0.01)
+
+    def test_timed_writer(self):
+        output = io.StringIO()
+        self.metrics.timed_writer("write", output).write("abc")
+        self.assertEqual("abc", output.getvalue())
+        self.assertGreater(self._stage("write"), 0)
+
+    def test_count_tokens(self):
+        tokens = [NoteToken("note"), NoteToken("note"), NoteToken("barend")]
+        self.metrics.count_tokens(tokens)
+        self.assertEqual(2, self.metrics.counters[("tokens_total", (("type", "note"),))])
+        self.assertEqual(1, self.metrics.counters[("tokens_total", (("type", "barend"),))])
+
+    def test_take_and_merge(self):
+        self.metrics.inc("files", 2)
+        self.metrics.observe("seconds", 0.02)
+        other = Metrics()
+        other.enable()
+        other.inc("files")
+        other.merge(self.metrics.take())
+        self.assertEqual({}, self.metrics.counters)
+        self.assertEqual(3, other.counters[("files", ())])
+        self.assertEqual(1, other.histograms[("seconds", ())].count)
+
+    def test_prometheus(self):
+        self.metrics.inc("jobs_total", status="Complete")
+        self.metrics.observe("job_seconds", 0.02)
+        self.metrics.gauge("render_queue_depth", lambda: 4)
+        text = self.metrics.prometheus()
+        self.assertIn('bpmusictransposer_jobs_total{status="Complete"} 1\n', text)
+        self.assertIn('bpmusictransposer_job_seconds_bucket{le="0.01"} 0\n', text)
+        self.assertIn('bpmusictransposer_job_seconds_bucket{le="0.025"} 1\n', text)
+        self.assertIn('bpmusictransposer_job_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn("# TYPE bpmusictransposer_render_queue_depth gauge\nbpmusictransposer_render_queue_depth 4\n", text)
+
+    def test_labelled_counter_gauge(self):
+        self.metrics.gauge("matcher_hits_total", lambda: {"note": 3, "grace": 1}, "Hits", "target", "counter")
+        text = self.metrics.prometheus()
+        self.assertIn("# TYPE bpmusictransposer_matcher_hits_total counter\n", text)
+        self.assertIn('bpmusictransposer_matcher_hits_total{target="grace"} 1\nbpmusictransposer_matcher_hits_total{target="note"} 3\n', text)
+
+if __name__ == "__main__":
+    unittest.main()
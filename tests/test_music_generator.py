@@ -0,0 +1,135 @@
+import unittest, io
+from fractions import Fraction
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.musicgenerator import MusicGenerator
+from bpmusictransposer.notetoken import NoteToken
+
+class TestMusicGenerator(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.maxDiff = None
+        self.parser = MusicParser.parsers["BagpipeMusicWriter"]
+        self.generator = MusicGenerator()
+        self.tune = self.parser.get_tune_from_file("omnitest/omnitest.bww")
+
+    def test_write_tune_matches_from_tune(self):
+        result = io.StringIO()
+        self.generator.write_tune(self.tune, result)
+        self.assertEqual(self.generator.from_tune(self.tune), result.getvalue())
+
+    def test_template_wraps_music(self):
+        result = self.generator.from_tune(self.parser.get_tune("& LA_4"))
+        (before_header, before_music, after_music) = self.generator.template_parts
+        self.assertTrue(result.startswith(before_header))
+        self.assertTrue(result.endswith(after_music))
+        self.assertIn("a'4", result)
+
+    def test_stem_override_before_first_note(self):
+        result = self.generator.from_tune(self.parser.get_tune("& LA_4 B_4"))
+        self.assertLess(result.index("\\override Stem.direction = -1"), result.index("b'4"))
+
+    def test_book_scores(self):
+        result = io.StringIO()
+        self.generator.write_book([self.tune, self.tune], result)
+        self.assertEqual(2, result.getvalue().count("\\score {"))
+        self.assertEqual(1, result.getvalue().count("\\version"))
+        self.assertNotIn("\\book", result.getvalue())
+
+    def test_book_split(self):
+        result = io.StringIO()
+        self.generator.write_book([self.tune, self.tune], result, ["first", "second"])
+        self.assertEqual(2, result.getvalue().count("\\book {"))
+        self.assertIn('\\bookOutputSuffix "first"', result.getvalue())
+        self.assertIn('\\bookOutputSuffix "second"', result.getvalue())
+
+    def _bars(self, music):
+        notes = self.parser.parse(music)
+        self.generator._bar_lengths = self.generator._measure_bars(notes)
+        return notes
+
+    def test_pickup(self):
+        self._bars("& sharpf sharpc 4_4 LA_8 ! B_4 C_4 D_4 E_4 !t")
+        self.assertEqual(Fraction(1, 8), self.generator._bar_lengths[0])
+        self.assertEqual(Fraction(1), self.generator._bar_lengths[6])
+        self.assertEqual("\\partial 8", self.generator._find_offset((4, 4), 0))
+        self.assertEqual("\\partial 1", self.generator._find_offset((4, 4), 6))
+
+    def test_pickup_off_the_beat(self):
+        self._bars("LA_8 B_8 C_8 ! D_4")
+        self.assertEqual(Fraction(3, 8), self.generator._bar_lengths[0])
+        self.assertEqual("\\set Timing.measurePosition = #(ly:make-moment 5/8)", self.generator._find_offset((4, 4), 0))
+        self.assertEqual("\\set Timing.measurePosition = #(ly:make-moment 3/8)", self.generator._find_offset((6, 8), 0))
+
+    def test_dotted_notes(self):
+        (dotted, cut, double_dotted, short) = self.parser.parse("LA_8 'la B_16 C_4 ''c D_16")
+        self.assertEqual(Fraction(3, 16), self.generator._note_length(dotted))
+        self.assertEqual(Fraction(7, 16), self.generator._note_length(double_dotted))
+        self._bars("LA_8 'la B_16 ! C_4")
+        self.assertEqual(Fraction(1, 4), self.generator._bar_lengths[0])
+        self.assertEqual("\\partial 4", self.generator._find_offset((4, 4), 0))
+        self._bars("C_4 ''c D_16 ! E_4")
+        self.assertEqual(Fraction(1, 2), self.generator._bar_lengths[0])
+        self.assertEqual("\\partial 2", self.generator._find_offset((4, 4), 0))
+
+    def test_tuplets(self):
+        notes = self._bars("^3s LA_8 B_8 C_8 ^3e ! D_4")
+        self.assertEqual(Fraction(1, 12), self.generator._note_length(notes[1]))
+        self.assertEqual(Fraction(1, 4), self.generator._bar_lengths[0])
+        self.assertEqual("\\partial 4", self.generator._find_offset((4, 4), 0))
+
+    def test_time_change(self):
+        notes = self._bars("& 4_4 LA_4 B_4 C_4 D_4 ! 6_8 E_8 F_8 HG_8 ! HA_4")
+        change = [t.get_type() for t in notes].index("time_notation", 2)
+        self.assertEqual(Fraction(3, 8), self.generator._bar_lengths[change + 1])
+        self.assertEqual("\\set Timing.measurePosition = #(ly:make-moment 3/8)", self.generator._find_offset((6, 8), change + 1))
+        # The offset is taken in the new time as the tune is written
+        result = self.generator.from_tune(self.parser.get_tune("& 4_4 LA_4 B_4 C_4 D_4 ! 6_8 I!'' E_8 F_8 HG_8 ! HA_4 ''!I"))
+        self.assertIn("\\time 6/8", result)
+        self.assertIn("make-moment 3/8", result[result.index("\\time 6/8"):])
+
+    def test_overfull_bar_starts_on_beat(self):
+        self._bars("LA_4 B_4 C_4 D_4 E_4 !")
+        self.assertEqual("\\set Timing.measurePosition = #(ly:make-moment 0/4)", self.generator._find_offset((4, 4), 0))
+
+    def _token(self, name, args=(), modifiers=None):
+        token = NoteToken(name)
+        token.set_args(list(args))
+        if modifiers:
+            token.add_modifiers(modifiers)
+        return token
+
+    def _getattr_decode(self, generator, token):
+        # What _decode did before the dispatch table, through methods and __getattr__
+        if token.modifiers:
+            return getattr(generator, token.note_type)(*token.ordered_arguments, **token.modifiers)
+        return getattr(generator, token.note_type)(*token.ordered_arguments)
+
+    def _assert_dispatch_matches(self, token):
+        (dispatched, looked_up) = (MusicGenerator(), MusicGenerator())
+        for generator in [dispatched, looked_up]:
+            generator._curr_time = (4, 4)
+        self.assertEqual(self._getattr_decode(looked_up, token), dispatched._decode(token))
+
+    def test_dispatch_simple_translation(self):
+        for name in MusicGenerator.simple_translation:
+            self._assert_dispatch_matches(self._token(name, ["F"]))
+        self.assertEqual("", MusicGenerator()._decode(self._token("sharpf")))
+
+    def test_dispatch_func_translation(self):
+        for name in MusicGenerator.func_translation:
+            self._assert_dispatch_matches(self._token(name))
+        self.assertIn("\\bar", MusicGenerator()._decode(self._token("barend")))
+
+    def test_dispatch_methods(self):
+        self._assert_dispatch_matches(self._token("note", ["LA", "4"]))
+        self._assert_dispatch_matches(self._token("note", ["B", "8"], {"dot": 1}))
+        self._assert_dispatch_matches(self._token("time_notation", ["6", "8"]))
+
+    def test_dispatch_unknown_type(self):
+        with self.assertRaises(AttributeError):
+            self._getattr_decode(MusicGenerator(), self._token("nosuchtype"))
+        with self.assertRaisesRegex(Exception, "has no attribute 'nosuchtype' in nosuchtype"):
+            MusicGenerator()._decode(self._token("nosuchtype", ["x"]))
+
+if __name__ == "__main__":
+    unittest.main()
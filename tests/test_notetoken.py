@@ -0,0 +1,44 @@
+import unittest, pickle
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.notetoken import NoteToken
+
+class TestNoteToken(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.maxDiff = None
+        self.parser = MusicParser.parsers["BagpipeMusicWriter"]
+
+    def test_modifiers_not_shared(self):
+        first = NoteToken("note")
+        second = NoteToken("note")
+        first.add_modifiers({"dot": 1})
+        self.assertEqual({"dot": 1}, first.modifiers)
+        self.assertEqual({}, second.modifiers)
+
+    def test_argument_indices_not_shared(self):
+        (first, second) = self.parser.parse("^3e ^3e")
+        self.assertIs(first.argument_indices, second.argument_indices)
+        first.set_arg("extra", "1")
+        self.assertIn("extra", first.argument_indices)
+        self.assertNotIn("extra", second.argument_indices)
+
+    def test_copy(self):
+        (token,) = self.parser.parse("dbe")
+        token.add_modifiers({"heavy": True})
+        copied = token.copy()
+        self.assertEqual(token, copied)
+        copied.add_modifiers({"half": True})
+        copied.set_arg("extra", "1")
+        self.assertNotIn("half", token.modifiers)
+        self.assertNotIn("extra", token.keyword_arguments)
+        self.assertNotIn("extra", token.argument_indices)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(NoteToken("note"), "__dict__"))
+
+    def test_pickle(self):
+        tokens = self.parser.parse("LG_4 'lg ^3s LA_8 B_8 C_8 ^3e gg")
+        self.assertEqual(tokens, pickle.loads(pickle.dumps(tokens)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest, sys, subprocess
+
+# Run in a fresh interpreter, other tests have already loaded the parsers in this one
+script = '''
+from bpmusictransposer import musicparser
+from bpmusictransposer.musicparser import MusicParser
+loads = []
+original = musicparser.load_parsers
+def counting():
+    loads.append(1)
+    original()
+musicparser.load_parsers = counting
+print(len(MusicParser.parsers))
+first = MusicParser.parsers["BagpipeMusicWriter"]
+second = MusicParser.parsers["BagpipeMusicWriter"]
+print(len(loads), first is second)
+try:
+    MusicParser.parsers["Missing"]
+except KeyError:
+    print("missing")
+print(len(loads))
+'''
+
+class TestParserRegistry(unittest.TestCase):
+    def test_loaded_on_first_lookup_only(self):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.split("\n")
+        self.assertEqual(["0", "1 True", "missing", "1"], output[:4])
+
+if __name__ == "__main__":
+    unittest.main()
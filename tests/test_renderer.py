@@ -0,0 +1,96 @@
+import unittest, os, sys, shutil, tempfile
+from bpmusictransposer.renderer import Renderer, RenderError
+
+# Stands in for lilypond: logs each run, writes a PDF per input unless the source asks it not to
+stand_in = '''#!%s
+import sys, os, time, resource
+output = sys.argv[1].split("=", 1)[1]
+with open(os.path.join(output, "runs.log"), "a") as log:
+    log.write(" ".join(os.path.basename(x) for x in sys.argv[2:]) + "\\n")
+failed = False
+for source in sys.argv[2:]:
+    content = open(source).read()
+    if "hang" in content:
+        time.sleep(30)
+    if "fail" in content:
+        failed = True
+        continue
+    with open(os.path.join(output, os.path.basename(source)[:-3] + ".pdf"), "w") as pdf:
+        pdf.write(str(resource.getrlimit(resource.RLIMIT_AS)[0]) if "limit" in content else "pdf")
+sys.exit(1 if failed else 0)
+''' % sys.executable
+
+class TestRenderer(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.executable = os.path.join(self.workdir, "lilypond")
+        with open(self.executable, 'w') as file:
+            file.write(stand_in)
+        os.chmod(self.executable, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _job(self, name, content="score"):
+        filename = os.path.join(self.workdir, name)
+        with open("%s.ly" % filename, 'w') as file:
+            file.write(content)
+        return filename
+
+    def _runs(self):
+        with open(os.path.join(self.workdir, "runs.log")) as log:
+            return [line.split() for line in log]
+
+    def test_render(self):
+        renderer = Renderer(self.executable)
+        renderer.start()
+        filename = self._job("a")
+        self.assertEqual(filename, renderer.render(filename).result(10))
+        renderer.stop()
+        self.assertTrue(os.path.isfile("%s.pdf" % filename))
+
+    def test_batches_pending_files(self):
+        renderer = Renderer(self.executable, batch_size=8)
+        futures = [renderer.render(self._job(name)) for name in ["a", "b", "c"]]
+        renderer.start()
+        renderer.stop()
+        self.assertTrue(all(future.result(0) for future in futures))
+        self.assertEqual([["a.ly", "b.ly", "c.ly"]], self._runs())
+
+    def test_failure_only_fails_its_file(self):
+        renderer = Renderer(self.executable, batch_size=8)
+        good = renderer.render(self._job("a"))
+        bad = renderer.render(self._job("b", "fail"))
+        renderer.start()
+        renderer.stop()
+        self.assertEqual(os.path.join(self.workdir, "a"), good.result(0))
+        self.assertIsInstance(bad.exception(0), RenderError)
+        self.assertEqual([["a.ly", "b.ly"], ["b.ly"]], self._runs())
+
+    def test_timeout(self):
+        renderer = Renderer(self.executable, timeout=0.5)
+        renderer.start()
+        future = renderer.render(self._job("a", "hang"))
+        self.assertIn("timed out", str(future.exception(10)))
+        renderer.stop()
+
+    def test_memory_limit(self):
+        renderer = Renderer(self.executable, memory_limit=1024 ** 3)
+        renderer.start()
+        filename = self._job("a", "limit")
+        renderer.render(filename).result(10)
+        renderer.stop()
+        with open("%s.pdf" % filename) as pdf:
+            self.assertEqual(str(1024 ** 3), pdf.read())
+        self.assertEqual([["a.ly"]], self._runs())
+
+    def test_slots(self):
+        renderer = Renderer(self.executable, slots=3)
+        renderer.start()
+        futures = [renderer.render(self._job(name)) for name in ["a", "b", "c", "d"]]
+        renderer.stop()
+        self.assertTrue(all(future.result(0) for future in futures))
+        self.assertEqual(4, len(self._runs()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest, os, shutil, tempfile
+from bpmusictransposer.resultcache import ResultCache
+
+class TestResultCache(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _job(self, name, content="x" * 10):
+        filename = os.path.join(self.workdir, name)
+        for extension in ["ly", "pdf"]:
+            with open("%s.%s" % (filename, extension), 'w') as file:
+                file.write(content)
+        return filename
+
+    def test_fetch_after_store(self):
+        cache = ResultCache(self.cache_dir, 1000)
+        key = cache.key(b"LA_4")
+        self.assertFalse(cache.fetch(key, os.path.join(self.workdir, "second")))
+        cache.store(key, self._job("first", "result"))
+        self.assertTrue(cache.fetch(key, os.path.join(self.workdir, "second")))
+        with open(os.path.join(self.workdir, "second.ly")) as file:
+            self.assertEqual("result", file.read())
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(self.cache_dir, 50)
+        cache.store("a", self._job("a"))
+        cache.store("b", self._job("b"))
+        self.assertTrue(cache.fetch("a", os.path.join(self.workdir, "a2")))
+        cache.store("c", self._job("c"))
+        self.assertEqual(["a", "c"], list(cache.entries.keys()))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "b")))
+
+    def test_reload(self):
+        cache = ResultCache(self.cache_dir, 1000)
+        cache.store("a", self._job("a"))
+        self.assertTrue(ResultCache(self.cache_dir, 1000).fetch("a", os.path.join(self.workdir, "a2")))
+
+    def test_key_includes_version(self):
+        cache = ResultCache(self.cache_dir, 1000)
+        self.assertNotEqual(cache.key(b"LA_4"), ResultCache(self.cache_dir, 1000, "changed").key(b"LA_4"))
+        self.assertEqual(cache.key(b"LA_4"), ResultCache(self.cache_dir, 1000).key(b"LA_4"))
+
+    def test_entries_published_whole(self):
+        cache = ResultCache(self.cache_dir, 1000)
+        cache.store("a", self._job("a"))
+        self.assertEqual(["a"], os.listdir(self.cache_dir))
+        self.assertEqual(["result.ly", "result.pdf"], sorted(os.listdir(os.path.join(self.cache_dir, "a"))))
+        # Left by a crash part way through a store, or by the old flat layout
+        os.mkdir(os.path.join(self.cache_dir, ".partial"))
+        self._job(os.path.join("cache", "old"))
+        reloaded = ResultCache(self.cache_dir, 1000)
+        self.assertEqual(["a"], list(reloaded.entries))
+        self.assertEqual(["a"], os.listdir(self.cache_dir))
+
+    def test_fetch_of_evicted_leaves_nothing(self):
+        cache = ResultCache(self.cache_dir, 1000)
+        cache.store("a", self._job("a"))
+        os.unlink(os.path.join(self.cache_dir, "a", "result.pdf"))
+        target = os.path.join(self.workdir, "a2")
+        self.assertFalse(cache.fetch("a", target))
+        self.assertFalse(os.path.exists("%s.ly" % target))
+
+    def test_refuses_shared_directory(self):
+        os.mkdir(self.cache_dir, 0o700)
+        os.chmod(self.cache_dir, 0o777)
+        with self.assertRaises(PermissionError):
+            ResultCache(self.cache_dir, 1000)
+        shutil.rmtree(self.cache_dir)
+        ResultCache(self.cache_dir, 1000)
+        self.assertEqual(0o700, os.stat(self.cache_dir).st_mode & 0o777)
+
+if __name__ == "__main__":
+    unittest.main()
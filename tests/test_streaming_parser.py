@@ -0,0 +1,130 @@
+import unittest, json
+from importlib import resources as impresources
+from bpmusictransposer import parserdefs
+from bpmusictransposer.musicparser import MusicParser
+
+class TestStreamingParser(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.maxDiff = None
+        self.parser = MusicParser.parsers["BagpipeMusicWriter"]
+
+    def test_matches_expected_tokens(self):
+        tunestr = "\n".join(['"Test Tune",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)',
+            'TuneTempo,90',
+            "& sharpf sharpc 4_4 I!'' gg LAr_8 'la Bl_16 ! dbe E_4",
+            "^3e C_8 ''!I"])
+        tuplet = {"tuplet": ["3", "2"], "state": "end"}
+        expected = [
+            ("title", ["Test Tune", "L,0,0,Times New Roman,16,700,0,0,18,0,0,0)"], {}),
+            ("tempo", ["90"], {}),
+            ("clefc", [], {}),
+            ("sharp", ["F"], {}),
+            ("sharp", ["C"], {}),
+            ("time_notation", ["4", "4"], {}),
+            ("repeatstart", [], {}),
+            ("grace", ["HG"], {}),
+            ("note", ["LA", "8"], dict(tuplet, dot=1)),
+            ("note", ["B", "16"], tuplet),
+            ("barend", [], {}),
+            ("double", ["E"], {}),
+            ("note", ["E", "4"], tuplet),
+            ("tuplet", ["2", None, "3", "E", None], tuplet),
+            ("note", ["C", "8"], {}),
+            ("repeatend", [], {})
+        ]
+        for tokens in [self.parser.parse(tunestr), list(self.parser.iter_tokens(line + "\n" for line in tunestr.split("\n")))]:
+            self.assertEqual(expected, [(t.get_type(), list(t.get_args()), dict(t.modifiers)) for t in tokens])
+
+    def test_unmatched_token_is_dropped_before_apply(self):
+        # Unknown tokens never reach the pending tokens, so a ^0e after one still reaches the note before it
+        tokens = self.parser.parse("LA_4 junk ^0e")
+        self.assertEqual(["note", "tuplet"], [t.get_type() for t in tokens])
+        self.assertEqual(["0", "2"], list(tokens[0].modifiers["tuplet"]))
+
+    def test_yields_before_end_of_stream(self):
+        consumed = []
+        def lines():
+            for line in ["& sharpf sharpc 4_4 LG_4 LA_4 B_4\n", "! C_4 D_4\n"]:
+                consumed.append(line)
+                yield line
+        tokens = self.parser.iter_tokens(lines())
+        self.assertEqual("clefc", next(tokens).get_type())
+        self.assertEqual(1, len(consumed))
+
+    def test_dot_applies_across_lines(self):
+        tokens = list(self.parser.iter_tokens(["LG_4", "'lg LA_8"]))
+        self.assertEqual({"dot": 1}, tokens[0].modifiers)
+
+    def test_repeated_tokens_are_copies(self):
+        (first, second) = self.parser.parse("LG_4 LG_4")
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        first.add_modifiers({"dot": 1})
+        self.assertEqual({}, second.modifiers)
+        # A dot applies to the note before it, so it is parsed again each time
+        tokens = self.parser.parse("LG_4 'lg LG_4 'lg")
+        self.assertEqual([{"dot": 1}, {"dot": 1}], [x.modifiers for x in tokens])
+        self.assertNotIn("'lg", self.parser.token_cache)
+
+    def test_token_cache_is_bounded(self):
+        parser = MusicParser(json.loads((impresources.files(parserdefs) / "BWW.v1.0.json").read_text()), register=False)
+        parser.token_cache_size = 2
+        parser.parse("LG_4 LA_4 B_4 LA_4")
+        self.assertEqual(["B_4", "LA_4"], list(parser.token_cache))
+
+    def test_tuplet_applies_to_held_notes(self):
+        tokens = list(self.parser.iter_tokens(["LA_8 B_8 C_8 ^3e"]))
+        self.assertEqual(["note", "note", "note", "tuplet"], [t.get_type() for t in tokens])
+        for note in tokens[:3]:
+            self.assertEqual(("3", "2"), tuple(note.modifiers["tuplet"]))
+
+    def test_tuplet_applies_to_latest_notes_only(self):
+        tokens = list(self.parser.iter_tokens(["LG_8 LA_8 ! gg B_8 strlg C_8 ! D_8 ^3e"]))
+        notes = [t for t in tokens if t.get_type() == "note"]
+        self.assertEqual([False, False, True, True, True], ["tuplet" in note.modifiers for note in notes])
+
+    def test_header_takes_first_of_each(self):
+        tune = self.parser.get_tune('"One",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)\n'
+                '"Two",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)\n& sharpf sharpc 4_4 LA_4 !t')
+        self.assertEqual("One", tune.title)
+        self.assertEqual(["title", "clefc", "sharp", "sharp", "time_notation", "note", "lineend"],
+                [t.get_type() for t in tune.notes])
+
+    def test_tune_header(self):
+        with open("omnitest/omnitest.bww", encoding=self.parser.encoding) as file:
+            tunestr = file.read()
+        header = self.parser.get_tune_header(tunestr)
+        single = self.parser.get_tune(tunestr)
+        for name in ["title", "tunetype", "composer", "tempo", "time"]:
+            self.assertEqual(getattr(single, name), getattr(header, name))
+        self.assertEqual(12345, header.tempo)
+        self.assertEqual([], header.notes)
+
+    def test_tempo_that_is_not_a_number(self):
+        for tune in [self.parser.get_tune("TuneTempo,fast\n& LA_4"), self.parser.get_tune_header("TuneTempo,fast\n& LA_4")]:
+            self.assertEqual(0, tune.tempo)
+
+    def test_tune_header_stops_at_time(self):
+        consumed = []
+        def lines():
+            for line in ['"Title",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)\n', "& sharpf sharpc 6_8 LA_4\n", "! C_4 D_4\n"]:
+                consumed.append(line)
+                yield line
+        header = self.parser.get_tune_header_from_stream(lines())
+        self.assertEqual(("Title", (6, 8)), (header.title, header.time))
+        self.assertEqual(2, len(consumed))
+
+    def test_tune_book(self):
+        with open("omnitest/omnitest.bww", encoding=self.parser.encoding) as file:
+            tunestr = file.read()
+        tunes = list(self.parser.iter_tunes((tunestr + "\n" + tunestr).split("\n")))
+        self.assertEqual(2, len(tunes))
+        single = self.parser.get_tune(tunestr)
+        for tune in tunes:
+            self.assertEqual(single.title, tune.title)
+            self.assertEqual(single.time, tune.time)
+        self.assertEqual(2 * len(single.notes), sum(len(tune.notes) for tune in tunes))
+
+if __name__ == "__main__":
+    unittest.main()
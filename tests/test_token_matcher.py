@@ -0,0 +1,71 @@
+import unittest, json, threading
+from importlib import resources as impresources
+from bpmusictransposer import parserdefs
+from bpmusictransposer.musicparser import MusicParser
+
+class TestTokenMatcher(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.maxDiff = None
+        self.parser = MusicParser.parsers["BagpipeMusicWriter"]
+        with open("omnitest/omnitest.bww", encoding=self.parser.encoding) as file:
+            self.tokens = set(file.read().split())
+
+    def _sequential_match(self, token):
+        for (target, matcher) in self.parser.parser_matchers:
+            if match := matcher(token):
+                return (target, match)
+        return None
+
+    def _test_helper(self, token):
+        expected = self._sequential_match(token)
+        result = self.parser.parser_matcher(token)
+        if expected is None:
+            self.assertIsNone(result)
+        else:
+            self.assertEqual(expected[0], result[0])
+            self.assertEqual(expected[1].groupdict(), result[1].groupdict())
+            self.assertEqual(expected[1].groups(), result[1].groups())
+            for name in expected[1].groupdict():
+                self.assertEqual(expected[1].span(name), result[1].span(name))
+
+    def test_definition_order_wins(self):
+        for token in ["LG_8", "!", "!t", "I!", "I!''", "''!I", "gg", "dbe", "tdbe", "hdbe", "C", "C_", "_C"]:
+            self._test_helper(token)
+
+    def test_omnitest_tokens(self):
+        for token in self.tokens:
+            self._test_helper(token)
+
+    def test_unknown_token(self):
+        self.assertIsNone(self.parser.parser_matcher("notatoken"))
+
+    def test_concurrent_first_match(self):
+        # The combined pattern is compiled by the first match, other threads must wait for all of it
+        for attempt in range(5):
+            parser = MusicParser(json.loads((impresources.files(parserdefs) / "BWW.v1.0.json").read_text()), register=False)
+            start = threading.Barrier(8)
+            results = []
+            def first_match():
+                start.wait()
+                try:
+                    results.append(parser.parser_matcher("LA_4")[0])
+                except Exception as e:
+                    results.append(e)
+            threads = [threading.Thread(target=first_match) for x in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(["note"] * 8, results)
+
+    def test_modifier_variants(self):
+        (half_heavy, thumb, dotted) = self.parser.parse("hhvthrd tdbe LA_4 ''la")
+        # A variant of a variant keeps the modifiers of both, on the base definition's type
+        self.assertEqual("throw", half_heavy.get_type())
+        self.assertEqual({"heavy": True, "half": True}, half_heavy.modifiers)
+        self.assertEqual(("double", {"thumb": True}), (thumb.get_type(), thumb.modifiers))
+        self.assertEqual({"dot": 2}, dotted.modifiers)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest, os, shutil, tempfile
+from unittest import mock
+from bpmusictransposer.transpose import convert_all, convert_book
+from bpmusictransposer.musicgenerator import MusicGenerator
+
+class TestBatchConversion(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.workdir = tempfile.mkdtemp()
+        self.filenames = []
+        for name in ["first.bww", "second.bww", "third.bww"]:
+            filename = os.path.join(self.workdir, name)
+            shutil.copy("omnitest/omnitest.bww", filename)
+            self.filenames.append(filename)
+        self.filenames.insert(1, os.path.join(self.workdir, "missing.bww"))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _test_helper(self, jobs):
+        results = list(convert_all(self.filenames, 0, jobs=jobs, ordered=True))
+        self.assertEqual(self.filenames, [filename for (filename, _) in results])
+        failed = [filename for (filename, error) in results if error]
+        self.assertEqual([self.filenames[1]], failed)
+        for filename in self.filenames[0:1] + self.filenames[2:]:
+            self.assertTrue(os.path.isfile("%s.ly" % filename))
+
+    def test_serial_isolates_failures(self):
+        self._test_helper(1)
+
+    def test_pool_isolates_failures(self):
+        self._test_helper(2)
+
+    def test_failed_generation_leaves_no_output(self):
+        def failing(generator, tune):
+            yield "partial output"
+            raise ValueError("generator failed")
+        filename = self.filenames[0]
+        with mock.patch.object(MusicGenerator, "_generate_music", failing):
+            [(_, error)] = convert_all([filename], 0)
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(["first.bww", "second.bww", "third.bww"], sorted(os.listdir(self.workdir)))
+        # Nothing is left in the way of trying again
+        [(_, error)] = convert_all([filename], 0)
+        self.assertIsNone(error)
+        self.assertTrue(os.path.isfile("%s.ly" % filename))
+
+    def test_output_mode_follows_umask(self):
+        umask = os.umask(0o027)
+        try:
+            [(filename, error)] = convert_all(self.filenames[:1], 0)
+        finally:
+            os.umask(umask)
+        self.assertIsNone(error)
+        self.assertEqual(0o640, os.stat("%s.ly" % filename).st_mode & 0o777)
+
+class TestBookConversion(TestBatchConversion):
+    def _test_helper(self, jobs):
+        output = os.path.join(self.workdir, "book.ly")
+        results = list(convert_book(self.filenames, output, 0, jobs=jobs))
+        self.assertEqual(self.filenames, [filename for (filename, _) in results])
+        self.assertEqual([self.filenames[1]], [filename for (filename, error) in results if error])
+        with open(output) as file:
+            self.assertEqual(3, file.read().count("\\score {"))
+
+    def test_existing_output_fails_before_parsing(self):
+        output = os.path.join(self.workdir, "book.ly")
+        with open(output, "w") as file:
+            file.write("kept")
+        with mock.patch("bpmusictransposer.transpose.parse_tunes") as parse_tunes:
+            [(filename, error)] = convert_book(self.filenames, output, 0)
+        parse_tunes.assert_not_called()
+        self.assertEqual(output, filename)
+        self.assertIsInstance(error, FileExistsError)
+        with open(output) as file:
+            self.assertEqual("kept", file.read())
+
+    def test_nothing_written_without_tunes(self):
+        output = os.path.join(self.workdir, "book.ly")
+        results = list(convert_book(self.filenames[1:2], output, 0))
+        self.assertIsInstance(results[0][1], FileNotFoundError)
+        self.assertEqual(1, len(results))
+        self.assertFalse(os.path.exists(output))
+
+    def test_failed_generation_leaves_no_output(self):
+        output = os.path.join(self.workdir, "book.ly")
+        with mock.patch.object(MusicGenerator, "write_book", side_effect=ValueError("generator failed")):
+            results = list(convert_book(self.filenames[:1], output, 0))
+        self.assertEqual([(self.filenames[0], None)], results[:1])
+        self.assertEqual(output, results[1][0])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertFalse(os.path.exists(output))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest, os, json, shutil, tempfile
+from importlib import resources as impresources
+from bpmusictransposer import parserdefs
+from bpmusictransposer.musicparser import MusicParser
+from bpmusictransposer.tunecache import TuneCache
+
+tune = b'''"Test Tune",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)
+& sharpf sharpc 4_4 LAr_8 'la Bl_16 !t
+'''
+
+class TestTuneCache(unittest.TestCase):
+    @classmethod
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.parser = MusicParser.parsers["BagpipeMusicWriter"]
+        self.parses = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _parse(self, stream):
+        self.parses += 1
+        return list(self.parser.iter_tunes(stream))
+
+    def test_parses_once(self):
+        cache = TuneCache(self.workdir, 100000)
+        first = cache.parse(tune, self.parser, "tunes", self._parse)
+        second = TuneCache(self.workdir, 100000).parse(tune, self.parser, "tunes", self._parse)
+        self.assertEqual(1, self.parses)
+        self.assertEqual("Test Tune", second[0].title)
+        self.assertEqual(first[0].notes, second[0].notes)
+        self.assertEqual({"dot": 1}, second[0].notes[-3].modifiers)
+
+    def test_key(self):
+        cache = TuneCache(self.workdir, 100000)
+        key = cache.key(tune, self.parser)
+        self.assertNotEqual(key, cache.key(tune + b"\n", self.parser))
+        self.assertNotEqual(key, cache.key(tune, self.parser, "tune"))
+        definitions = json.loads((impresources.files(parserdefs) / "BWW.v1.0.json").read_text())
+        self.assertEqual(key, cache.key(tune, MusicParser(definitions, register=False)))
+        definitions["_parser_defs"].append({ "target": "clefc", "pattern": "clef" })
+        self.assertNotEqual(key, cache.key(tune, MusicParser(definitions, register=False)))
+        cache.code_version = "changed"
+        self.assertNotEqual(key, cache.key(tune, self.parser))
+
+    def _entries(self):
+        return sorted(name[:-len(".pickle")] for name in os.listdir(self.workdir) if name.endswith(".pickle"))
+
+    def test_evicts_least_recently_used(self):
+        cache = TuneCache(self.workdir, 100)
+        cache.store("a", "x" * 20)
+        cache.store("b", "x" * 20)
+        self.assertEqual("x" * 20, cache.fetch("a"))
+        cache.store("c", "x" * 20)
+        self.assertEqual(["a", "c"], self._entries())
+        self.assertIsNone(cache.fetch("b"))
+
+    def test_bound_shared_between_processes(self):
+        # Each instance stands in for a process sharing the directory
+        caches = [TuneCache(self.workdir, 100) for x in range(3)]
+        for (i, cache) in enumerate(caches):
+            cache.store(str(i), "x" * 20)
+        self.assertEqual(["1", "2"], self._entries())
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.workdir, "%s.pickle" % key)) for key in self._entries()), 100)
+
+    def test_refuses_shared_directory(self):
+        os.chmod(self.workdir, 0o777)
+        with self.assertRaises(PermissionError):
+            TuneCache(self.workdir, 100)
+        os.chmod(self.workdir, 0o700)
+        shared = os.path.join(self.workdir, "new")
+        TuneCache(shared, 100)
+        self.assertEqual(0o700, os.stat(shared).st_mode & 0o777)
+
+if __name__ == "__main__":
+    unittest.main()
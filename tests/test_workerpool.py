@@ -0,0 +1,133 @@
+import unittest, os, sys, time, shutil, tempfile, threading
+from unittest import mock
+from bpmusictransposer.musicgenerator import MusicGenerator
+from bpmusictransposer import threadedworker
+from bpmusictransposer.threadedworker import WorkerPool
+from bpmusictransposer.jobstore import open_job_store
+from bpmusictransposer.renderer import Renderer
+from bpmusictransposer.tunecache import TuneCache
+
+stand_in = '''#!%s
+import sys, os
+output = sys.argv[1].split("=", 1)[1]
+for source in sys.argv[2:]:
+    with open(os.path.join(output, os.path.basename(source)[:-3] + ".pdf"), "w") as pdf:
+        pdf.write("pdf")
+''' % sys.executable
+
+tune = b'''"Test Tune",(T,L,0,0,Times New Roman,16,700,0,0,18,0,0,0)
+& sharpf sharpc 4_4 LAr_8 Bl_8 !t
+'''
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        executable = os.path.join(self.workdir, "lilypond")
+        with open(executable, 'w') as file:
+            file.write(stand_in)
+        os.chmod(executable, 0o755)
+        self.renderer = Renderer(executable)
+        self.pool = WorkerPool(self.workdir, open_job_store(os.path.join(self.workdir, "job.list")), renderer=self.renderer)
+
+    def tearDown(self):
+        self.pool.stop()
+        shutil.rmtree(self.workdir)
+
+    def test_source_written_at_upload(self):
+        self.pool.queue_job("a", "a.bww", tune)
+        self.assertEqual("Rendering", self.pool.get_job_status("a")["status"])
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir, "a.ly")))
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, "a.pdf")))
+        self.pool.start()
+        self.assertEqual("Complete", self.pool.wait_job_status("a", "Rendering", 10)["status"])
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir, "a.pdf")))
+
+    def test_starts_without_waiting_for_file(self):
+        # The upload's bytes are handed over, nothing polls for a saved file
+        self.pool.start()
+        start = time.perf_counter()
+        self.pool.queue_job("a", "a.bww", tune)
+        self.assertEqual("Complete", self.pool.wait_job_status("a", "Rendering", 10)["status"])
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, "a.bww")))
+
+    def test_conversion_error_raised(self):
+        self.pool.start()
+        with self.assertRaises(UnicodeDecodeError):
+            self.pool.queue_job("a", "a.bww", b"\x81")
+        self.assertEqual("Failed", self.pool.get_job_status("a")["status"])
+        self.assertEqual({}, self.pool.in_flight)
+
+    def test_failed_generation_leaves_no_source(self):
+        self.pool.start()
+        with mock.patch.object(MusicGenerator, "write_book", side_effect=ValueError("generator failed")):
+            with self.assertRaises(ValueError):
+                self.pool.queue_job("a", "a.bww", tune)
+        self.assertEqual("Failed", self.pool.get_job_status("a")["status"])
+        self.assertFalse([name for name in os.listdir(self.workdir) if name.startswith(("a.", ".a."))])
+
+    def test_batch(self):
+        self.pool.start()
+        jobs = self.pool.queue_batch("b", [("a.bww", tune), ("bad.bww", b"\x81"), ("c.bww", tune + b"\n")])
+        statuses = self.pool.wait_batch("b", 10)
+        self.assertEqual(jobs, [x["uuid"] for x in statuses])
+        self.assertEqual(["Complete", "Failed", "Complete"], [x["status"] for x in statuses])
+        self.assertIsNone(self.pool.get_batch_statuses("missing"))
+
+        reloaded = WorkerPool(self.workdir, open_job_store(os.path.join(self.workdir, "job.list")), renderer=self.renderer)
+        self.assertEqual(statuses, reloaded.get_batch_statuses("b"))
+
+    def test_batch_returns_before_converting(self):
+        release = threading.Event()
+        original = threadedworker.convert_source
+        def blocked(*args):
+            release.wait(10)
+            return original(*args)
+        self.pool.start()
+        with mock.patch.object(threadedworker, "convert_source", blocked):
+            jobs = self.pool.queue_batch("b", [("a.bww", tune), ("c.bww", tune + b"\n")])
+            self.assertEqual(["Processing", "Processing"], [x["status"] for x in self.pool.get_batch_statuses("b")])
+            release.set()
+            statuses = self.pool.wait_batch("b", 10)
+        self.assertEqual(jobs, [x["uuid"] for x in statuses])
+        self.assertEqual(["Complete", "Complete"], [x["status"] for x in statuses])
+
+    def test_instances_keep_own_state(self):
+        other_dir = tempfile.mkdtemp()
+        try:
+            other = WorkerPool(other_dir, open_job_store(os.path.join(other_dir, "job.list")), renderer=Renderer(self.renderer.executable))
+            self.pool.start()
+            self.pool.queue_job("a", "a.bww", tune)
+            self.assertIsNone(other.get_job_status("a"))
+            self.assertIsNot(self.pool.parse_status, other.parse_status)
+            self.assertIsNot(self.pool.in_flight, other.in_flight)
+            other.start()
+            other.stop()
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_processes(self):
+        self.pool.executor.shutdown()
+        self.pool.store.close()
+        self.pool = WorkerPool(self.workdir, open_job_store(os.path.join(self.workdir, "job.list")), count=2, processes=True, renderer=self.renderer)
+        self.pool.start()
+        for name in ["a", "b"]:
+            self.pool.queue_job(name, "%s.bww" % name, tune)
+        for name in ["a", "b"]:
+            self.assertEqual("Complete", self.pool.wait_job_status(name, "Rendering", 10)["status"])
+            self.assertTrue(os.path.isfile(os.path.join(self.workdir, "%s.pdf" % name)))
+
+    def test_tune_cache(self):
+        tune_cache = TuneCache(os.path.join(self.workdir, "tunes"), 100000)
+        self.pool.tune_cache = tune_cache
+        self.pool.start()
+        entries = lambda: [name for name in os.listdir(tune_cache.cache_dir) if name.endswith(".pickle")]
+        self.pool.queue_job("a", "a.bww", tune)
+        self.assertEqual(1, len(entries()))
+        self.pool.queue_job("b", "b.bww", tune)
+        self.assertEqual(1, len(entries()))
+        with open(os.path.join(self.workdir, "a.ly")) as first, open(os.path.join(self.workdir, "b.ly")) as second:
+            self.assertEqual(first.read(), second.read())
+
+if __name__ == "__main__":
+    unittest.main()